@@ -3,9 +3,32 @@ import time
 from datetime import datetime
 import csv
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 np.set_printoptions(formatter={"float": lambda x: "{0:0.2f}".format(x)})
 
+# NER weights of the best model, written in the best model directory by
+# save_best_model(lightweight=True) and removed by export_best_model
+NER_CHECKPOINT_FILENAME = "ner_checkpoint.bin"
+
+
+def write_bytes(path, data):
+    """
+    Writes bytes to a file atomically, so a reader never finds it half written.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def evaluated_scores(state, score):
+    """
+    Returns the history of a score without the epochs in which it was not
+    evaluated (see `val_every` and `train_eval_size` in train_config.json).
+    """
+    return [value for value in state["history"][score] if value is not None]
+
 
 # example of callback structure
 def example(param="value"):
@@ -48,10 +71,14 @@ def print_scores_on_epoch(validation=True):
     return print_scores_cb
 
 
-def save_best_model(path_best_model="", threshold=40, score="val_f_score", mode="max", test=False):
+def save_best_model(path_best_model="", threshold=40, score="val_f_score", mode="max", test=False, lightweight=False):
     """
     Save the model if the epoch score is more than the threshold
     or if current score is a new max.
+    When lightweight, only the NER weights are serialized and they are written
+    by a background thread, so training is not blocked writing vectors and
+    other pipes. Use it with the `export_best_model` on_stop callback, which
+    writes the full model once.
 
     :param path_best_model where to save the model. This callback add this path to the history when saved
     :param threshold value to reach in order to save the first time
@@ -59,10 +86,33 @@ def save_best_model(path_best_model="", threshold=40, score="val_f_score", mode=
     :param mode gives the possibility to use scores with minimun like "ner" loss as trigger.
     posible values "min" or "max"
     :param test boolean value used to trigger a score evaluation with test dataset
+    :param lightweight boolean value to save only the NER weights in background
     """
+    writer = ThreadPoolExecutor(max_workers=1) if lightweight else None
+
+    def save_ner_checkpoint(state, logger, model, optimizer):
+        e = state["i"] + 1
+        if "ner_snapshot" in state:
+            # weights of the epoch scored by the async evaluation (already averaged)
+            ner_bytes = state["ner_snapshot"]
+        else:
+            with model.use_params(optimizer.averages):
+                ner_bytes = model.get_pipe("ner").to_bytes(exclude=["vocab"])
+        os.makedirs(path_best_model, exist_ok=True)
+        checkpoint_path = os.path.join(path_best_model, NER_CHECKPOINT_FILENAME)
+        # waits the previous write, so checkpoints are written in order
+        if "checkpoint_write" in state:
+            state["checkpoint_write"].result()
+        state["checkpoint_write"] = writer.submit(write_bytes, checkpoint_path, ner_bytes)
+        state["best_checkpoint"] = {"path": checkpoint_path, "model_path": path_best_model, "epoch": e}
+        logger.info(f"💾 Saving NER checkpoint for epoch {e}")
+        state["history"]["saved"][state["i"]] = path_best_model
 
     def save_best_model_cb(state, logger, model, optimizer, disabled_pipes):
         save = False
+        if state["history"][score][-1] is None:
+            # the score was not evaluated in this epoch
+            return state
 
         if mode == "max":
             save = (state["history"][score][-1] >= threshold) and (state["history"][score][-1] > state["max_" + score])
@@ -75,6 +125,12 @@ def save_best_model(path_best_model="", threshold=40, score="val_f_score", mode=
                 # change this flag to
                 state["evaluate_test"] = True
 
+            if lightweight:
+                save_ner_checkpoint(state, logger, model, optimizer)
+                return state
+            if "ner_snapshot" in state:
+                logger.warning("[save_best_model] async_eval is enabled: the saved weights are newer than the scored ones")
+
             # add pipes for the current model
             for pipe in disabled_pipes:
                 model.add_pipe(pipe[1], before="ner")
@@ -105,7 +161,7 @@ def reduce_lr_on_plateau(step=0.001, epochs=4, diff=1, score="val_f_score", last
     Whe the model is not getting better scores (plateau or decrease)
     from the selected amount of last epochs this function sets the
     learning rate decreasing it a fixed step.
-    Note: Uses the average of last scores
+    Note: Uses the average of last scores. Epochs without evaluation are skipped
     :param step fixed amout to decrease the learning rate
     :param epochs last epochs to be considered
     :param diff score difference amount to produce a change in the the learning rate
@@ -114,8 +170,9 @@ def reduce_lr_on_plateau(step=0.001, epochs=4, diff=1, score="val_f_score", last
     """
 
     def reduce_lr_on_plateau_cb(state, logger, model, optimizer, disabled_pipes):
-        if len(state["history"][score]) > epochs and state["lr"] > step:
-            delta = np.diff(state["history"][score])[-epochs:]
+        history = evaluated_scores(state, score)
+        if state["history"][score][-1] is not None and len(history) > epochs and state["lr"] > step:
+            delta = np.diff(history)[-epochs:]
 
             if np.mean(delta) < diff:
                 # maybe you have been getting bad scores but the last epoch shed a glimmer of hope
@@ -136,7 +193,7 @@ def reduce_lr_on_plateau(step=0.001, epochs=4, diff=1, score="val_f_score", last
 def early_stop(epochs=10, score="val_f_score", diff=5, last_chance=True):
     """
     Sets the stop value to True in state if score is not improving during the last epochs
-    Note: Uses the average of last scores
+    Note: Uses the average of last scores. Epochs without evaluation are skipped
     :param epochs last epochs to be considered
     :param diff score difference amount to produce a change in the the learning rate
     :param score score used to calculate the diff
@@ -144,8 +201,9 @@ def early_stop(epochs=10, score="val_f_score", diff=5, last_chance=True):
     """
 
     def early_stop_cb(state, logger, model, optimizer, disabled_pipes):
-        if len(state["history"][score]) > epochs:
-            delta = np.diff(state["history"][score])[-epochs:]
+        history = evaluated_scores(state, score)
+        if state["history"][score][-1] is not None and len(history) > epochs:
+            delta = np.diff(history)[-epochs:]
 
             print(delta, " - suma de diff: ", np.sum(delta))
             if np.sum(delta) < diff:
@@ -170,14 +228,12 @@ def update_best_scores(validation=True):
     def update_best_scores_cb(state, logger, model, optimizer, disabled_pipes):
         # max and min
         state["min_ner"] = min(state["history"]["ner"])
-        state["max_f_score"] = max(state["history"]["f_score"])
-        state["max_recall"] = max(state["history"]["recall"])
-        state["max_precision"] = max(state["history"]["precision"])
-
+        # epochs without evaluation are skipped
+        scores = ["f_score", "macro_f_score", "recall", "precision"]
         if validation:
-            state["max_val_f_score"] = max(state["history"]["val_f_score"])
-            state["max_val_recall"] = max(state["history"]["val_recall"])
-            state["max_val_precision"] = max(state["history"]["val_precision"])
+            scores += ["val_f_score", "val_macro_f_score", "val_recall", "val_precision"]
+        for score in scores:
+            state["max_" + score] = max(evaluated_scores(state, score), default=state["max_" + score])
         return state
 
     return update_best_scores_cb
@@ -200,6 +256,93 @@ def sleep(secs=0.5, log=False):
     return sleep_cb
 
 
+def cpu_load():
+    """
+    Returns the 1 minute load average by CPU, or None where it is not
+    available.
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def memory_usage():
+    """
+    Returns the fraction of used memory (from /proc/meminfo), or None where it
+    is not available.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        total = int(meminfo["MemTotal"].split()[0])
+        available = int(meminfo["MemAvailable"].split()[0])
+        return 1 - available / total
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def throttle(max_load=1.5, max_memory=0.9, max_latency=3.0, secs=1, max_secs=60, log=True):
+    """
+    Pause the train loop only when the machine is under pressure, instead of
+    sleeping on every call like `sleep`. It pauses (checking again every `secs`
+    seconds, `max_secs` at most) while the load average by CPU is over
+    `max_load`, the fraction of used memory is over `max_memory` or the time
+    since the last call is more than `max_latency` times its running average.
+    Latency is measured within an epoch, so the first batch of each epoch
+    (which follows the evaluation) is not compared. The throttled seconds are added to state["throttled_secs"].
+    :param max_load load average by CPU to pause at
+    :param max_memory fraction of used memory to pause at
+    :param max_latency ratio between the last batch latency and the average to pause at
+    :param secs seconds between checks while paused
+    :param max_secs maximum seconds paused by call
+    :param log when true each pause is logged
+    """
+    timer = {"last": None, "average": None, "epoch": None}
+
+    def pressure(latency):
+        load = cpu_load()
+        if load is not None and load > max_load:
+            return f"load average by CPU {load:.2f} > {max_load}"
+        memory = memory_usage()
+        if memory is not None and memory > max_memory:
+            return f"memory usage {memory:.2f} > {max_memory}"
+        if latency is not None and timer["average"] and latency > max_latency * timer["average"]:
+            return f"latency {latency:.2f}s > {max_latency} x {timer['average']:.2f}s"
+        return None
+
+    def throttle_cb(state, logger, model, optimizer, disabled_pipes):
+        if state.get("i") != timer["epoch"]:
+            timer["epoch"] = state.get("i")
+            timer["last"] = None
+        now = time.time()
+        latency = now - timer["last"] if timer["last"] is not None else None
+        reason = pressure(latency)
+        if latency is not None and reason is None:
+            # running average of the latencies without pressure
+            timer["average"] = latency if timer["average"] is None else 0.9 * timer["average"] + 0.1 * latency
+
+        cause = reason
+        throttled = 0
+        while reason is not None and throttled < max_secs:
+            time.sleep(secs)
+            throttled += secs
+            # latency only triggers the first pause
+            reason = pressure(None)
+
+        if throttled:
+            state["throttled_secs"] = state.get("throttled_secs", 0) + throttled
+            if log:
+                logger.info(
+                    f"[throttle] paused {throttled} secs ({state['throttled_secs']} secs in total) because of {cause}"
+                )
+        # paused time is not counted as latency of the next batch
+        timer["last"] = time.time()
+        return state
+
+    return throttle_cb
+
+
 def change_dropout_fixed(step=0.01, until=0.5):
     """
     [experimental] change the dropout each epoch
@@ -229,6 +372,37 @@ def change_dropout_fixed(step=0.01, until=0.5):
 # on stop plugins
 
 
+def export_best_model():
+    """
+    Writes the full best model once, from the NER checkpoint saved by
+    save_best_model(lightweight=True): waits for the pending write, re-adds
+    the disabled pipes, loads the best NER weights and saves the model to the
+    checkpoint model path.
+    """
+
+    def export_best_model_cb(state, logger, model, optimizer, disabled_pipes):
+        checkpoint = state.get("best_checkpoint")
+        if checkpoint is None:
+            logger.info("[export_best_model] There is no checkpoint to export")
+            return state
+
+        # a resumed training has no pending write
+        if "checkpoint_write" in state:
+            state.pop("checkpoint_write").result()
+        for pipe in disabled_pipes:
+            model.add_pipe(pipe[1], before="ner")
+        with open(checkpoint["path"], "rb") as f:
+            model.get_pipe("ner").from_bytes(f.read(), exclude=["vocab"])
+        os.remove(checkpoint["path"])
+
+        model.to_disk(checkpoint["model_path"])
+        e = checkpoint["epoch"]
+        logger.info(f"[export_best_model] 💾 Model of epoch {e} saved in {checkpoint['model_path']}")
+        return state
+
+    return export_best_model_cb
+
+
 def log_best_scores(validation=True):
     """
     Logs the max/mins from state
@@ -241,6 +415,7 @@ def log_best_scores(validation=True):
         e = state["i"]
         logger.info(f"using a dataset of length {state['train_size']} in {e}/{state['epochs']}")
         logger.info(f"elapsed time: {state['elapsed_time']} minutes")
+        logger.info(f"throttled time: {state.get('throttled_secs', 0)} secs")
         logger.info(f"NER loss -> min {state['min_ner']}")
         # Scores
         if validation:
@@ -284,14 +459,17 @@ def save_csv_history(filename="history.csv", session="", validation=True):
             "session",
             "epoch",
             "batches",
+            "samples",
             "lr",
             "dropout",
             "ner",
             "f_score",
+            "macro_f_score",
             "recall",
             "precision",
             "per_type_score",
             "val_f_score",
+            "val_macro_f_score",
             "val_recall",
             "val_precision",
             "val_per_type_score",
@@ -304,25 +482,30 @@ def save_csv_history(filename="history.csv", session="", validation=True):
 
             if validation:
                 val_f_score = state["history"]["val_f_score"][i]
+                val_macro_f_score = state["history"]["val_macro_f_score"][i]
                 val_recall = state["history"]["val_recall"][i]
                 val_precision = state["history"]["val_precision"][i]
                 val_per_type_score = state["history"]["val_per_type_score"][i]
             else:
                 val_f_score, val_recall, val_precision, val_per_type_score = None, None, None, None
+                val_macro_f_score = None
 
             rows.append(
                 {
                     "session": s,
                     "epoch": i + 1,
                     "batches": state["history"]["batches"][i],
+                    "samples": state["history"]["samples"][i],
                     "lr": state["history"]["lr"][i],
                     "dropout": state["history"]["dropout"][i],
                     "ner": state["history"]["ner"][i],
                     "f_score": state["history"]["f_score"][i],
+                    "macro_f_score": state["history"]["macro_f_score"][i],
                     "recall": state["history"]["recall"][i],
                     "precision": state["history"]["precision"][i],
                     "per_type_score": state["history"]["per_type_score"][i],
                     "val_f_score": val_f_score,
+                    "val_macro_f_score": val_macro_f_score,
                     "val_recall": val_recall,
                     "val_precision": val_precision,
                     "val_per_type_score": val_per_type_score,
@@ -0,0 +1,167 @@
+import logging
+import os
+import re
+import sqlite3
+from os import listdir
+from os.path import isfile, join
+from corpus import read_dataturks_file
+
+logger = logging.getLogger("Spacy cli concordance.py")
+
+# Characters fetched on each side of an annotation for every context word
+CHARS_BY_CONTEXT_WORD = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, file_id INTEGER, content TEXT);
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY, document_id INTEGER, label TEXT, text TEXT, start_offset INTEGER, end_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS documents_file ON documents (file_id);
+CREATE INDEX IF NOT EXISTS annotations_document ON annotations (document_id);
+CREATE INDEX IF NOT EXISTS annotations_label_text ON annotations (label, text);
+"""
+
+
+def open_index(index_path):
+    """
+    Opens (and creates if needed) a SQLite concordance index.
+    """
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def remove_file(connection, file_id):
+    connection.execute(
+        "DELETE FROM annotations WHERE document_id IN (SELECT id FROM documents WHERE file_id = ?)", (file_id,)
+    )
+    connection.execute("DELETE FROM documents WHERE file_id = ?", (file_id,))
+    connection.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+
+def annotation_label(annotation):
+    """
+    Returns the label of a dataturks annotation. Annotations with a list of
+    labels are labeled by the first one, as they are when converted.
+    """
+    label = annotation["label"]
+    return label[0] if isinstance(label, list) else label
+
+
+def index_file(connection, path, mtime, size):
+    cursor = connection.execute("INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)", (path, mtime, size))
+    file_id = cursor.lastrowid
+    for data in read_dataturks_file(path):
+        cursor = connection.execute(
+            "INSERT INTO documents (file_id, content) VALUES (?, ?)", (file_id, data["content"])
+        )
+        document_id = cursor.lastrowid
+        rows = []
+        for a in data["annotation"] or []:
+            point = a["points"][0]
+            rows.append((document_id, annotation_label(a), point["text"], point["start"], point["end"]))
+        connection.executemany(
+            "INSERT INTO annotations (document_id, label, text, start_offset, end_offset) VALUES (?, ?, ?, ?, ?)", rows
+        )
+
+
+def directory_prefix(files_path):
+    """
+    Returns the prefix of the indexed paths of the files in a directory.
+    """
+    return os.path.join(os.path.abspath(files_path), "")
+
+
+def update_index(connection, files_path):
+    """
+    Given an open index and a directory of dataturks .json files, indexes new
+    and modified files (by modification time and size) and removes deleted
+    ones. Each file is indexed in its own transaction: files that are not
+    dataturks files are logged and skipped, and the index file itself is
+    skipped when it is in the directory. Returns a tuple with the number of
+    indexed and removed files.
+
+    :param connection: A connection returned by `open_index`.
+    :param files_path: Directory pointing to dataturks .json files.
+    """
+    # the index database and its journal files
+    index_path = connection.execute("PRAGMA database_list").fetchone()[2]
+    files = {}
+    for f in listdir(files_path):
+        path = os.path.abspath(join(files_path, f))
+        if isfile(path) and not (index_path and path.startswith(index_path)):
+            stat = os.stat(path)
+            files[path] = (stat.st_mtime, stat.st_size)
+
+    prefix = directory_prefix(files_path)
+    indexed = {
+        path: (file_id, (mtime, size))
+        for file_id, path, mtime, size in connection.execute("SELECT id, path, mtime, size FROM files")
+        if path.startswith(prefix)
+    }
+
+    updated, removed = 0, 0
+    with connection:
+        for path, (file_id, _) in indexed.items():
+            if path not in files:
+                remove_file(connection, file_id)
+                removed += 1
+    for path, (mtime, size) in files.items():
+        if path in indexed and indexed[path][1] == (mtime, size):
+            continue
+        logger.info(f'Indexing file "{path}"...')
+        try:
+            with connection:
+                if path in indexed:
+                    remove_file(connection, indexed[path][0])
+                index_file(connection, path, mtime, size)
+            updated += 1
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logger.warning(f'Skipping file "{path}", it could not be read as a dataturks file: {e!r}')
+    return updated, removed
+
+
+def find_concordances(connection, files_path, entity, context_words=0):
+    """
+    Given an open index, a directory and an entity label, returns a list of
+    tuples with every distinct annotation text of that label in the files of
+    the directory, its left and right context of up to `context_words` words,
+    and its start and end offsets. Only the first occurrence of each text is
+    returned. An index can hold several directories.
+
+    :param connection: A connection returned by `open_index`.
+    :param files_path: Directory pointing to dataturks .json files.
+    :param entity: entity label name.
+    :param context_words: integer for nbor words.
+    """
+    window = context_words * CHARS_BY_CONTEXT_WORD
+    prefix = directory_prefix(files_path)
+    # paths are compared by their prefix, as LIKE patterns would treat "_" and "%" in paths as wildcards
+    rows = connection.execute(
+        """
+        SELECT a.text, a.start_offset, a.end_offset,
+               substr(d.content, max(1, a.start_offset + 1 - ?), min(a.start_offset, ?)),
+               substr(d.content, a.end_offset + 2, ?)
+        FROM annotations a JOIN documents d ON d.id = a.document_id JOIN files f ON f.id = d.file_id
+        WHERE substr(f.path, 1, length(?)) = ? AND a.id IN (
+            SELECT min(a.id)
+            FROM annotations a JOIN documents d ON d.id = a.document_id JOIN files f ON f.id = d.file_id
+            WHERE a.label = ? AND substr(f.path, 1, length(?)) = ?
+            GROUP BY a.text
+        )
+        ORDER BY a.id
+        """,
+        (window, window, window, prefix, prefix, entity, prefix, prefix),
+    )
+    left_context = re.compile(r"(?:\S+\s+){0,%d}\S*$" % context_words)
+    right_context = re.compile(r"\S*(?:\s+\S+){0,%d}\s*" % context_words)
+    concordances = []
+    for text, start, end, left, right in rows:
+        if context_words:
+            left = left_context.search(left).group()
+            right = right_context.match(right).group()
+        else:
+            left, right = "", ""
+        concordances.append((text, left, right, start, end))
+    return concordances
@@ -0,0 +1,699 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate, chain, islice, repeat
+import spacy
+from spacy.gold import GoldParse
+from spacy.tokens import Doc, DocBin
+
+logger = logging.getLogger("Spacy cli corpus.py")
+
+MANIFEST_FILENAME = "manifest.json"
+SHARD_EXTENSIONS = {"": ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+# Bump it whenever the conversion output changes to invalidate cached files
+CONVERSION_CACHE_VERSION = 1
+# Sentinel for exhausted iterators
+STOP = object()
+# Places where a document can be split into training windows
+WINDOW_SEPARATORS = {"paragraph": re.compile(r"\n\s*"), "sentence": re.compile(r"(?<=[.!?])\s+|\n\s*")}
+
+
+def read_dataturks_file(dataturks_JSON_file_path):
+    """
+    Given a dataturks .json format file, lazily yields each annotated document
+    parsing one JSON line at a time, so the file is never fully loaded.
+
+    :param dataturks_JSON_file_path: A string representing the path to a
+    dataturks .json format file.
+    """
+    with open(dataturks_JSON_file_path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def resolve_overlapped_annotations(annotations):
+    """
+    Given a list of `(start, end, label)` annotations with exclusive end
+    offsets, keeps the longest ones and discards every annotation that
+    overlaps, contains or is contained by an already kept one. Between
+    overlapped annotations of the same length the first one is kept. Returns
+    a tuple with the kept annotations sorted by start and the discarded ones.
+
+    :param annotations: A list of `(start, end, label)` tuples.
+    """
+    kept_starts = []
+    kept = []
+    overlapped = []
+    for annotation in sorted(annotations, key=lambda a: a[1] - a[0], reverse=True):
+        start, end = annotation[0], annotation[1]
+        i = bisect_right(kept_starts, start)
+        # Kept intervals never overlap each other, so only the closest kept
+        # neighbours can collide with the new one.
+        if (i > 0 and kept[i - 1][1] > start) or (i < len(kept) and kept[i][0] < end):
+            overlapped.append(annotation)
+        else:
+            # list.insert is O(n), but documents have few annotations and the
+            # memmove is cheaper than a sorted container for these sizes
+            kept_starts.insert(i, start)
+            kept.insert(i, annotation)
+    return kept, overlapped
+
+
+def iter_dataturks_to_spacy(dataturks_JSON_file_path, entity_list, overlapped_by_entities=None, errors=None):
+    """
+    Given a dataturks .json format file and a list of entities, lazily yields
+    `(text, {"entities": [(start, end, label), ...]})` training examples, one
+    per document. Overlapped annotations are discarded, preferring the longest
+    ones.
+
+    :param dataturks_JSON_file_path: A string representing the path to a
+    dataturks .json format file.
+    :param entity_list: A list of entities to be considered during annotations
+    extraction.
+    :param overlapped_by_entities: An optional Counter updated with the number
+    of discarded overlapped annotations by entity.
+    :param errors: An optional list where the error that stopped the
+    conversion is appended, as errors are logged and the file is left partly
+    converted.
+    """
+    try:
+        for data in read_dataturks_file(dataturks_JSON_file_path):
+            text = data["content"]
+            annotations = []
+            for annotation in data["annotation"] or []:
+                point = annotation["points"][0]
+                label = annotation["label"]
+                if label[0] in entity_list:
+                    if isinstance(label, list):
+                        label = label[0]
+                    # dataturks end offsets are inclusive
+                    annotations.append((point["start"], point["end"] + 1, label))
+
+            entities, overlapped = resolve_overlapped_annotations(annotations)
+            if overlapped_by_entities is not None:
+                overlapped_by_entities.update(annotation[2] for annotation in overlapped)
+            yield (text, {"entities": entities})
+    except Exception as e:
+        logging.exception("Unable to process " + dataturks_JSON_file_path + "\n" + "error = " + str(e))
+        if errors is not None:
+            errors.append(e)
+
+
+def conversion_cache_key(dataturks_JSON_file_path, entity_list):
+    """
+    Returns a key identifying the conversion of a dataturks file: a hash of
+    the file content, the entity list and the conversion cache version.
+    """
+    digest = hashlib.sha256(f"v{CONVERSION_CACHE_VERSION}".encode())
+    entities = entity_list if isinstance(entity_list, str) else sorted(entity_list)
+    digest.update(json.dumps(entities, ensure_ascii=False).encode())
+    with open(dataturks_JSON_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert_dataturks_file(dataturks_JSON_file_path, entity_list, cache_dir=""):
+    """
+    Given a dataturks .json format file and a list of entities, returns a tuple
+    with the list of training examples, a Counter of discarded overlapped
+    annotations by entity and whether the result came from the cache. Meant to
+    be run in worker processes.
+
+    :param cache_dir: An optional directory where converted files are cached
+    by content hash and entity list. Unchanged files are not parsed again.
+    Files whose conversion failed are not cached.
+    """
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir, conversion_cache_key(dataturks_JSON_file_path, entity_list) + ".json.gz"
+        )
+        if os.path.isfile(cache_path):
+            with gzip.open(cache_path, "rt", encoding="utf-8") as f:
+                cached = json.load(f)
+            # JSON has no tuples: examples are returned as they are converted
+            examples = [
+                (text, {**annotations, "entities": [tuple(entity) for entity in annotations["entities"]]})
+                for text, annotations in cached["examples"]
+            ]
+            return examples, Counter(cached["overlapped"]), True
+
+    overlapped_by_entities = Counter()
+    errors = []
+    examples = list(iter_dataturks_to_spacy(dataturks_JSON_file_path, entity_list, overlapped_by_entities, errors))
+
+    # partly converted files are not cached, so they are converted again
+    if cache_dir and not errors:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename so an interrupted run never leaves a broken entry
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"examples": examples, "overlapped": overlapped_by_entities}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    return examples, overlapped_by_entities, False
+
+
+@lru_cache(maxsize=None)
+def get_blank_tokenizer(lang="es"):
+    return spacy.blank(lang).tokenizer
+
+
+def histogram_bucket(value):
+    """
+    Returns the power of two upper bound of the histogram bucket of a value.
+    """
+    return 0 if value <= 0 else 2 ** math.ceil(math.log2(value))
+
+
+def dataturks_file_stats(dataturks_JSON_file_path, entity_list):
+    """
+    Given a dataturks .json format file and a list of entities, returns a dict
+    of Counters with the file statistics: documents, annotations, documents
+    and discarded overlaps by entity, and text length, token count and entity
+    density (entities every 1000 tokens) histograms. Meant to be run in worker
+    processes and merged with `merge_stats`.
+    """
+    tokenizer = get_blank_tokenizer()
+    stats = {
+        "totals": Counter(),
+        "entities": Counter(),
+        "documents_by_entities": Counter(),
+        "overlapped": Counter(),
+        "text_length": Counter(),
+        "tokens": Counter(),
+        "density": Counter(),
+    }
+    for text, annotations in iter_dataturks_to_spacy(dataturks_JSON_file_path, entity_list, stats["overlapped"]):
+        labels = [entity[2] for entity in annotations["entities"]]
+        tokens = len(tokenizer(text))
+        stats["totals"].update(documents=1, chars=len(text), tokens=tokens, entities=len(labels))
+        stats["entities"].update(labels)
+        stats["documents_by_entities"].update(set(labels))
+        stats["text_length"][histogram_bucket(len(text))] += 1
+        stats["tokens"][histogram_bucket(tokens)] += 1
+        stats["density"][histogram_bucket(1000 * len(labels) / tokens if tokens else 0)] += 1
+    return stats
+
+
+def merge_stats(stats_list):
+    """
+    Sums the Counters of several `dataturks_file_stats` results and returns a
+    JSON serializable report.
+    """
+    merged = {}
+    for stats in stats_list:
+        for key, counter in stats.items():
+            merged.setdefault(key, Counter()).update(counter)
+
+    totals = merged.get("totals", Counter())
+    tokens = totals["tokens"]
+    report = {
+        "documents": totals["documents"],
+        "chars": totals["chars"],
+        "tokens": tokens,
+        "entities": totals["entities"],
+        "entity_density": round(1000 * totals["entities"] / tokens, 4) if tokens else 0,
+        "entities_by_label": dict(merged.get("entities", {})),
+        "documents_by_label": dict(merged.get("documents_by_entities", {})),
+        "entity_density_by_label": {
+            label: round(1000 * count / tokens, 4) for label, count in merged.get("entities", {}).items()
+        }
+        if tokens
+        else {},
+        "overlapped_by_label": dict(merged.get("overlapped", {})),
+    }
+    # histograms are keyed by their bucket upper bound
+    for key in ["text_length", "tokens", "density"]:
+        report[f"{key}_histogram"] = {str(bucket): count for bucket, count in sorted(merged.get(key, {}).items())}
+    return report
+
+
+def write_json_array(output_file_path, examples):
+    """
+    Given an output path and an iterable of training examples, writes them
+    as a JSON array one example at a time, so the whole corpus never needs to
+    be held in memory. Returns the number of written examples.
+
+    :param output_file_path: The path and name of the output file.
+    :param examples: An iterable of `(text, annotations)` examples.
+    """
+    count = 0
+    with open(output_file_path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for example in examples:
+            f.write(",\n" if count else "\n")
+            f.write(json.dumps(example, ensure_ascii=False))
+            count += 1
+        f.write("\n]\n")
+    return count
+
+
+def split_aligned_entities(doc, entities):
+    """
+    Given a tokenized Doc and a list of `(start, end, label)` entities with
+    character offsets, returns a tuple with the entities whose offsets match
+    token boundaries and the misaligned ones.
+    """
+    token_starts = set()
+    token_ends = set()
+    for token in doc:
+        token_starts.add(token.idx)
+        token_ends.add(token.idx + len(token))
+    aligned, misaligned = [], []
+    for entity in entities:
+        if entity[0] in token_starts and entity[1] in token_ends:
+            aligned.append(entity)
+        else:
+            misaligned.append(entity)
+    return aligned, misaligned
+
+
+_tokenizer = None
+
+
+def init_tokenizer(lang, tokenizer_bytes):
+    """
+    Process pool initializer that rebuilds a model tokenizer from its bytes,
+    avoiding to load the whole model in every worker.
+    """
+    global _tokenizer
+    nlp = spacy.blank(lang)
+    nlp.tokenizer.from_bytes(tokenizer_bytes)
+    _tokenizer = nlp.tokenizer
+
+
+def remove_misaligned_batch(batch, tokenizer=None, batch_size=64):
+    """
+    Given a list of `(text, annotations)` examples, tokenizes them in a single
+    batch and returns, for every example, the list of entities aligned to
+    token boundaries. Uses the tokenizer built by `init_tokenizer` when none
+    is given.
+    """
+    tokenizer = tokenizer or _tokenizer
+    docs = tokenizer.pipe((get_text(text) for text, _ in batch), batch_size=batch_size)
+    return [split_aligned_entities(doc, annotations.get("entities"))[0] for doc, (_, annotations) in zip(docs, batch)]
+
+
+def write_docbin(output_file_path, examples, nlp):
+    """
+    Given an output path, an iterable of training examples and a Spacy
+    language, tokenizes every text once and writes the corpus as serialized
+    Docs (DocBin). Gold entities are kept as character offsets already
+    aligned to the tokens; annotations that do not match token boundaries are
+    discarded. Returns a tuple with the number of written docs and a Counter
+    of discarded misaligned annotations by entity.
+
+    :param output_file_path: The path and name of the output file.
+    :param examples: An iterable of `(text, annotations)` examples.
+    :param nlp: A Spacy language whose tokenizer is used.
+    """
+    # Entities are stored as user data instead of doc.ents: NER update treats
+    # pre-set entities as constraints, so training docs must stay unannotated.
+    doc_bin = DocBin(attrs=[], store_user_data=True)
+    misaligned_by_entities = Counter()
+    count = 0
+    for text, annotations in examples:
+        doc = nlp.make_doc(text)
+        entities, misaligned = split_aligned_entities(doc, annotations.get("entities"))
+        misaligned_by_entities.update(entity[2] for entity in misaligned)
+        doc.user_data["entities"] = [tuple(entity) for entity in entities]
+        doc_bin.add(doc)
+        count += 1
+
+    with open(output_file_path, "wb") as f:
+        f.write(doc_bin.to_bytes())
+    return count, misaligned_by_entities
+
+
+def read_docbin(input_file_path, nlp):
+    """
+    Given a corpus written by `write_docbin` and a Spacy language, lazily
+    yields `(doc, {"entities": [...]})` examples with pre-tokenized Docs.
+
+    :param input_file_path: A string representing the path to a .spacy file.
+    :param nlp: A Spacy language whose vocab is used to rebuild the Docs.
+    """
+    with open(input_file_path, "rb") as f:
+        doc_bin = DocBin(store_user_data=True).from_bytes(f.read())
+    for doc in doc_bin.get_docs(nlp.vocab):
+        entities = [tuple(entity) for entity in doc.user_data.pop("entities", [])]
+        yield (doc, {"entities": entities})
+
+
+def open_shard(shard_path, mode, compression=""):
+    """
+    Opens a JSONL shard in text mode ("r" or "w") with the given compression:
+    "" (none), "gzip" or "zstd". zstd requires the optional `zstandard`
+    package.
+    """
+    if compression == "gzip":
+        return gzip.open(shard_path, mode + "t", encoding="utf-8")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the zstandard package: pip install zstandard")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(open(shard_path, "wb"))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(shard_path, "rb"))
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    if compression != "":
+        raise ValueError(f'Unknown compression "{compression}". Use one of: "", "gzip", "zstd".')
+    return open(shard_path, mode, encoding="utf-8")
+
+
+class ShardWriter(object):
+    """
+    ShardWriter: Writes training examples as JSONL shards of at most
+    `shard_size` examples each into an output directory. Closing it writes a
+    manifest.json describing every shard (examples, bytes and entities count).
+    """
+
+    def __init__(self, output_dir, shard_size=10000, compression="gzip"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.compression = compression
+        self.shards = []
+        self.labels = Counter()
+        self.shard_file = None
+        self.shard_labels = None
+
+    def close_shard(self):
+        self.shard_file.close()
+        shard = self.shards[-1]
+        shard["bytes"] = os.path.getsize(os.path.join(self.output_dir, shard["path"]))
+        shard["labels"] = dict(self.shard_labels)
+
+    def write(self, example):
+        if self.shard_file is None or self.shards[-1]["examples"] == self.shard_size:
+            if self.shard_file is not None:
+                self.close_shard()
+            shard_name = f"shard-{len(self.shards):05d}{SHARD_EXTENSIONS[self.compression]}"
+            self.shard_file = open_shard(os.path.join(self.output_dir, shard_name), "w", self.compression)
+            self.shard_labels = Counter()
+            self.shards.append({"path": shard_name, "examples": 0})
+
+        text, annotations = example
+        self.shard_file.write(json.dumps((get_text(text), annotations), ensure_ascii=False) + "\n")
+        self.shards[-1]["examples"] += 1
+        example_labels = [entity[2] for entity in annotations.get("entities")]
+        self.shard_labels.update(example_labels)
+        self.labels.update(example_labels)
+
+    def close(self):
+        """
+        Closes the last shard, writes the manifest and returns it.
+        """
+        if self.shard_file is not None:
+            self.close_shard()
+            self.shard_file = None
+
+        manifest = {
+            "format": "jsonl",
+            "compression": self.compression,
+            "examples": sum(shard["examples"] for shard in self.shards),
+            "labels": dict(self.labels),
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.output_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+
+
+def write_jsonl_shards(output_dir, examples, shard_size=10000, compression="gzip"):
+    """
+    Given an output directory and an iterable of training examples, writes
+    them as JSONL shards with a manifest.json (see ShardWriter). Returns the
+    manifest.
+
+    :param output_dir: The directory where shards and manifest are written.
+    :param examples: An iterable of `(text, annotations)` examples.
+    :param shard_size: The maximum number of examples by shard.
+    :param compression: One of "" (none), "gzip" or "zstd".
+    """
+    writer = ShardWriter(output_dir, shard_size, compression)
+    for example in examples:
+        writer.write(example)
+    return writer.close()
+
+
+def uniform(rng):
+    """
+    Returns a random float in the open interval (0, 1).
+    """
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample(examples, size, rng=random):
+    """
+    Given an iterable of examples, returns a uniform random sample of `size`
+    examples reading them only once and keeping only the sample in memory
+    (reservoir sampling, "Algorithm L"). Returns every example when there are
+    fewer than `size`.
+
+    :param examples: An iterable of examples.
+    :param size: The sample size.
+    :param rng: A random.Random instance (or the random module).
+    """
+    examples = iter(examples)
+    reservoir = list(islice(examples, size))
+    if len(reservoir) < size:
+        return reservoir
+
+    w = math.exp(math.log(uniform(rng)) / size)
+    while True:
+        # skips the examples that would not enter the reservoir
+        skip = math.floor(math.log(uniform(rng)) / math.log(1 - w))
+        example = next(islice(examples, skip, skip + 1), STOP)
+        if example is STOP:
+            return reservoir
+        reservoir[rng.randrange(size)] = example
+        w *= math.exp(math.log(uniform(rng)) / size)
+
+
+def example_stratum(annotations):
+    """
+    Returns the stratum of an example: its sorted set of entity labels.
+    """
+    return "|".join(sorted({entity[2] for entity in annotations.get("entities")}))
+
+
+def split_corpus_examples(examples, proportions, rng=random):
+    """
+    Given an iterable of examples and a list of `(split_name, proportion)`
+    tuples, lazily yields `(split_name, example)` tuples. Examples are
+    stratified by the set of entity labels they contain: each one goes to the
+    split of its stratum with the largest deficit against its proportion plus
+    a random jitter, so every stratum keeps the proportions (within a couple of
+    examples) in a single streamed pass.
+
+    :param examples: An iterable of `(text, annotations)` examples.
+    :param proportions: A list of `(split_name, proportion)` tuples.
+    :param rng: A random.Random instance (or the random module).
+    """
+    total = sum(proportion for _, proportion in proportions)
+    proportions = [(name, proportion / total) for name, proportion in proportions if proportion > 0]
+    assigned_by_stratum = {}
+    for example in examples:
+        assigned = assigned_by_stratum.setdefault(example_stratum(example[1]), Counter())
+        n = sum(assigned.values()) + 1
+        name = max(proportions, key=lambda p: p[1] * n - assigned[p[0]] + rng.random())[0]
+        assigned[name] += 1
+        yield name, example
+
+
+def split_into_windows(text, annotations, by="paragraph", max_chars=2000):
+    """
+    Splits a long example into paragraph or sentence windows and yields a
+    `(window_text, {"entities": [...]})` tuple for each one, with the entity
+    offsets remapped to the window. Consecutive paragraphs (or sentences) are
+    merged while the window has at most `max_chars` characters. A document is
+    never split inside an entity, so a window can be longer than `max_chars`
+    when a single paragraph is. Pre-tokenized Docs are split by their text.
+
+    :param text: A raw string or a pre-tokenized Doc.
+    :param annotations: A dict with the "entities" character offsets.
+    :param by: "paragraph" or "sentence".
+    :param max_chars: preferred maximum number of characters by window.
+    """
+    text = get_text(text)
+    entities = sorted(annotations.get("entities", []))
+    # a cut is inside an entity when an entity starting before it ends after
+    # it: the furthest end of the entities sorted by start is enough to know
+    starts = [start for start, _, _ in entities]
+    furthest_ends = list(accumulate((end for _, end, _ in entities), max))
+
+    def inside_entity(cut):
+        i = bisect_left(starts, cut)
+        return i > 0 and furthest_ends[i - 1] > cut
+
+    boundaries = [m.end() for m in WINDOW_SEPARATORS[by].finditer(text) if 0 < m.end() < len(text)]
+    boundaries = [b for b in boundaries if not inside_entity(b)] + [len(text)]
+
+    window_start, entity_index = 0, 0
+    for i, window_end in enumerate(boundaries):
+        # keeps adding paragraphs while the next one still fits in the window
+        if i + 1 < len(boundaries) and boundaries[i + 1] - window_start <= max_chars:
+            continue
+        window_entities = []
+        while entity_index < len(entities) and entities[entity_index][0] < window_end:
+            start, end, label = entities[entity_index]
+            window_entities.append((start - window_start, end - window_start, label))
+            entity_index += 1
+        window_text = text[window_start:window_end]
+        # trailing whitespace is dropped unless an entity ends inside it
+        stripped = max([len(window_text.rstrip())] + [end for _, end, _ in window_entities])
+        if stripped > 0:
+            yield window_text[:stripped], {"entities": window_entities}
+        window_start = window_end
+
+
+def read_manifest(corpus_dir):
+    """
+    Returns the manifest of a sharded corpus written by `write_jsonl_shards`.
+    """
+    with open(os.path.join(corpus_dir, MANIFEST_FILENAME), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_shard(shard_path, compression=""):
+    """
+    Lazily yields the `(text, annotations)` examples of a JSONL shard.
+    """
+    with open_shard(shard_path, "r", compression) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_shard(shard_path, compression=""):
+    """
+    Returns the list of examples of a JSONL shard. Meant to be run in worker
+    processes.
+    """
+    return list(iter_shard(shard_path, compression))
+
+
+def is_sharded_corpus(input_path):
+    return os.path.isfile(os.path.join(input_path, MANIFEST_FILENAME))
+
+
+def iter_corpus(input_path, nlp=None):
+    """
+    Given the path to a converted corpus, lazily yields its examples. Sharded
+    JSONL corpora and .spacy files are streamed; .json corpora are a single
+    JSON array and have to be loaded at once.
+
+    :param input_path: A string representing the path to the corpus: a .json
+    file, a .spacy file or a sharded corpus directory.
+    :param nlp: A Spacy language, only needed to rebuild pre-tokenized Docs.
+    """
+    if is_sharded_corpus(input_path):
+        manifest = read_manifest(input_path)
+        for shard in manifest["shards"]:
+            yield from iter_shard(os.path.join(input_path, shard["path"]), manifest["compression"])
+    elif input_path.endswith(".spacy"):
+        yield from read_docbin(input_path, nlp)
+    else:
+        with open(input_path) as f:
+            yield from json.load(f)
+
+
+def read_corpus(input_path, nlp=None, workers=1):
+    """
+    Given the path to a converted corpus, returns its list of examples. Texts
+    are raw strings for .json and sharded corpora and pre-tokenized Docs for
+    .spacy ones.
+
+    :param input_path: A string representing the path to the corpus.
+    :param nlp: A Spacy language used to rebuild pre-tokenized Docs.
+    :param workers: An integer with the number of processes used to read the
+    shards of a sharded corpus.
+    """
+    if workers > 1 and is_sharded_corpus(input_path):
+        manifest = read_manifest(input_path)
+        paths = [os.path.join(input_path, shard["path"]) for shard in manifest["shards"]]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(chain.from_iterable(executor.map(read_shard, paths, repeat(manifest["compression"]))))
+    return list(iter_corpus(input_path, nlp))
+
+
+def get_text(text):
+    """
+    Returns the raw string of an example text, which can be a pre-tokenized
+    Doc.
+    """
+    return text.text if isinstance(text, Doc) else text
+
+
+def make_doc(nlp, text):
+    """
+    Returns an unannotated Doc for an example text. Raw strings are tokenized
+    and pre-tokenized Docs are copied, so predictions never leak into the
+    cached training Docs.
+
+    :param nlp: A Spacy language.
+    :param text: A raw string or a pre-tokenized Doc.
+    """
+    if isinstance(text, Doc):
+        return Doc(nlp.vocab, words=[token.text for token in text], spaces=[bool(token.whitespace_) for token in text])
+    return nlp.make_doc(text)
+
+
+def make_gold_example(nlp, text, annotations):
+    """
+    Returns a `(doc, gold)` tuple ready for `nlp.update`, so texts are
+    tokenized and aligned to their annotations only once. Pre-tokenized Docs
+    are used as they are.
+
+    :param nlp: A Spacy language.
+    :param text: A raw string or a pre-tokenized Doc.
+    :param annotations: A dict with the "entities" character offsets.
+    """
+    doc = text if isinstance(text, Doc) else nlp.make_doc(text)
+    return (doc, GoldParse(doc, entities=annotations.get("entities")))
+
+
+def aligned_entities(doc, entities):
+    """
+    Returns the `(start, end, label)` entities whose character offsets match
+    token boundaries of the doc. As in spacy's Scorer, misaligned entities
+    ("-" BILUO tags) are left out of the gold entities that are scored.
+
+    :param doc: A Doc tokenized as the gold text.
+    :param entities: A list of `(start, end, label)` character offsets.
+    """
+    return [tuple(entity) for entity in entities if doc.char_span(entity[0], entity[1]) is not None]
+
+
+def predict_batch(nlp, texts, batch_size=64, n_process=1):
+    """
+    Runs example texts, raw strings or pre-tokenized Docs, through the `pipe`
+    method of each enabled component, in batches of `batch_size`, and yields
+    the predicted Docs in order. With `n_process` > 1 texts are sent to
+    `nlp.pipe` worker processes as raw strings, so pre-tokenized Docs are
+    tokenized again there.
+    """
+    if n_process > 1:
+        yield from nlp.pipe((get_text(text) for text in texts), batch_size=batch_size, n_process=n_process)
+        return
+    docs = (make_doc(nlp, text) for text in texts)
+    for _, proc in nlp.pipeline:
+        docs = proc.pipe(docs, batch_size=batch_size) if hasattr(proc, "pipe") else map(proc, docs)
+    yield from docs
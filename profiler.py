@@ -0,0 +1,108 @@
+import time
+from collections import defaultdict
+import numpy as np
+from corpus import histogram_bucket
+
+# Percentiles reported for each profiled step
+PERCENTILES = [50, 90, 99]
+
+
+class PipelineProfiler(object):
+    """
+    Measures the wall time of an inference pipeline by document: the
+    tokenizer, each component, the EntityMatcher after callbacks and each
+    EntityCustom rule function (the time of every call of a rule within a
+    document is added up). Components are found by their attributes, so the
+    copies of the components in packaged models are profiled too. Steps named
+    "component/function" are part of their component time.
+    """
+
+    def __init__(self, nlp):
+        self.nlp = nlp
+        self.times = {}  # step -> seconds by document
+        self.lengths = []  # tokens by document
+        self.current = None
+        for name, proc in nlp.pipeline:
+            if hasattr(proc, "after_callbacks"):
+                proc.after_callbacks = [
+                    self.timed(f"{name}/{getattr(cb, 'name', type(cb).__name__)}", cb) for cb in proc.after_callbacks
+                ]
+            for rules in ("tagged_fns_token", "tagged_fns_ent"):
+                for tagged_fn in getattr(proc, rules, []):
+                    tagged_fn["fn"] = self.timed(f"{name}/{tagged_fn['fn'].__name__}", tagged_fn["fn"])
+
+    def timed(self, step, fn):
+        def timed_fn(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.current[step] += time.perf_counter() - start
+
+        return timed_fn
+
+    def __call__(self, text):
+        """
+        Runs the pipeline over a raw text and records its times.
+        """
+        self.current = defaultdict(float)
+        start = time.perf_counter()
+        doc = self.nlp.make_doc(text)
+        self.current["tokenizer"] = time.perf_counter() - start
+        for name, proc in self.nlp.pipeline:
+            start = time.perf_counter()
+            doc = proc(doc)
+            self.current[name] = time.perf_counter() - start
+        self.current["total"] = sum(seconds for step, seconds in self.current.items() if "/" not in step)
+
+        # steps that were not called for a document took 0 seconds in it
+        for step in set(self.times) | set(self.current):
+            if step not in self.times:
+                self.times[step] = [0.0] * len(self.lengths)
+            self.times[step].append(self.current.get(step, 0.0))
+        self.lengths.append(len(doc))
+        return doc
+
+    def report(self):
+        """
+        Returns a dict with the number of docs and, by step, the total and
+        mean seconds, the percentiles of seconds by document and the total
+        seconds by document length bucket (tokens, a power of 2).
+        """
+        if not self.lengths:
+            return {"docs": 0, "docs_by_length": {}, "steps": {}}
+        buckets = np.array([histogram_bucket(length) for length in self.lengths])
+        steps = {}
+        for step, times in self.times.items():
+            times = np.array(times)
+            steps[step] = {
+                "total": float(times.sum()),
+                "mean": float(times.mean()),
+                **{f"p{p}": float(np.percentile(times, p)) for p in PERCENTILES},
+                "by_length": {
+                    str(int(bucket)): float(times[buckets == bucket].sum()) for bucket in np.unique(buckets)
+                },
+            }
+        docs_by_length = {str(int(bucket)): int((buckets == bucket).sum()) for bucket in np.unique(buckets)}
+        return {"docs": len(self.lengths), "docs_by_length": docs_by_length, "steps": steps}
+
+
+def format_report(report):
+    """
+    Formats a PipelineProfiler report as a text table, in milliseconds, with
+    the steps sorted by total time.
+    """
+    buckets = list(report["docs_by_length"])
+    header = ["step", "total", "mean"] + [f"p{p}" for p in PERCENTILES] + [f"<={b} tok" for b in buckets]
+    rows = [header]
+    for step, values in sorted(report["steps"].items(), key=lambda item: -item[1]["total"]):
+        cells = [values["total"], values["mean"]] + [values[f"p{p}"] for p in PERCENTILES]
+        cells += [values["by_length"].get(b, 0) for b in buckets]
+        rows.append([step] + [f"{seconds * 1000:.2f}" for seconds in cells])
+    rows.append(["docs", "", ""] + [""] * len(PERCENTILES) + [str(report["docs_by_length"][b]) for b in buckets])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = []
+    for row in rows:
+        cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        lines.append("  ".join(cells))
+    return "\n".join(lines)
@@ -0,0 +1,105 @@
+import numpy as np
+
+# Row and column of the confusion table for spans without an entity
+NONE_LABEL = "O"
+
+
+def safe_divide(a, b):
+    """
+    Element-wise division that returns 0 where the divisor is 0.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+
+class EntityScorer(object):
+    """
+    Corpus-level NER scorer. Collects the gold and predicted `(start, end,
+    label)` character spans of every document of an evaluation pass and
+    computes micro and macro averaged precision, recall and F-score, and a
+    per-label confusion table, with array operations. As in spacy's Scorer
+    spans must match exactly, and scores are percentages.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.gold = []  # (doc, start, end, label id) rows
+        self.predicted = []
+        self.docs = 0
+
+    def label_id(self, label):
+        return self.labels.setdefault(label, len(self.labels))
+
+    def add(self, predicted, gold):
+        """
+        Adds the entities of a document.
+
+        :param predicted: An iterable of predicted `(start, end, label)` spans.
+        :param gold: An iterable of gold `(start, end, label)` spans.
+        """
+        self.predicted.extend((self.docs, start, end, self.label_id(label)) for start, end, label in predicted)
+        self.gold.extend((self.docs, start, end, self.label_id(label)) for start, end, label in gold)
+        self.docs += 1
+
+    def add_doc(self, doc, entities):
+        """
+        Adds a predicted Doc and its gold entities character offsets.
+        """
+        self.add([(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents], entities)
+
+    def confusion(self):
+        """
+        Returns a tuple with the list of labels (NONE_LABEL last) and the
+        confusion table: an array where [i, j] counts the spans with gold
+        label i and predicted label j.
+        """
+        none = len(self.labels)
+        gold = np.array(self.gold, dtype=np.int64).reshape(-1, 4)
+        predicted = np.array(self.predicted, dtype=np.int64).reshape(-1, 4)
+        # the same span id for the same (doc, start, end) in gold and predicted
+        spans = np.concatenate([gold[:, :3], predicted[:, :3]])
+        unique_spans, span_ids = np.unique(spans, axis=0, return_inverse=True)
+        span_ids = span_ids.reshape(-1)
+
+        gold_labels = np.full(len(unique_spans), none)
+        gold_labels[span_ids[: len(gold)]] = gold[:, 3]
+        predicted_labels = np.full(len(unique_spans), none)
+        predicted_labels[span_ids[len(gold) :]] = predicted[:, 3]
+
+        table = np.zeros((none + 1, none + 1), dtype=np.int64)
+        np.add.at(table, (gold_labels, predicted_labels), 1)
+        return list(self.labels) + [NONE_LABEL], table
+
+    def scores(self):
+        """
+        Returns a dict with the "micro" and "macro" averaged scores (dicts
+        with "p", "r" and "f" keys), the scores of each label by "per_type"
+        and the "confusion" table as a dict of gold label to a dict of
+        predicted label counts.
+        """
+        labels, table = self.confusion()
+        true_positives = np.diag(table)[:-1]
+        predicted = table[:, :-1].sum(axis=0)
+        gold = table[:-1, :].sum(axis=1)
+
+        precision = safe_divide(true_positives, predicted)
+        recall = safe_divide(true_positives, gold)
+        f_score = safe_divide(2 * precision * recall, precision + recall)
+
+        micro_p = safe_divide(true_positives.sum(), predicted.sum())
+        micro_r = safe_divide(true_positives.sum(), gold.sum())
+        micro_f = safe_divide(2 * micro_p * micro_r, micro_p + micro_r)
+
+        def percentages(p, r, f):
+            return {"p": float(p) * 100, "r": float(r) * 100, "f": float(f) * 100}
+
+        return {
+            "micro": percentages(micro_p, micro_r, micro_f),
+            "macro": percentages(*(values.mean() if len(values) else 0 for values in (precision, recall, f_score))),
+            "per_type": {label: percentages(*values) for label, *values in zip(labels, precision, recall, f_score)},
+            "confusion": {
+                gold_label: {label: int(count) for label, count in zip(labels, row) if count}
+                for gold_label, row in zip(labels, table)
+            },
+        }
@@ -0,0 +1,135 @@
+from concordance import annotation_label, find_concordances, open_index, update_index
+
+import json
+import os
+import tempfile
+import unittest
+
+
+def dataturks_line(content, annotations):
+    """
+    Returns a dataturks document line with `(label, text)` annotations of the
+    first occurrence of each text (dataturks end offsets are inclusive).
+    """
+    annotation = []
+    for label, text in annotations:
+        start = content.index(text)
+        annotation.append({"label": label, "points": [{"start": start, "end": start + len(text) - 1, "text": text}]})
+    return json.dumps({"content": content, "annotation": annotation}, ensure_ascii=False) + "\n"
+
+
+class ConcordanceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.files_dir = tempfile.TemporaryDirectory()
+        self.files_path = self.files_dir.name
+        self.write(
+            "a.json",
+            dataturks_line(
+                "El señor Juan Pérez vive en Córdoba capital.", [(["PER"], "Juan Pérez"), ("LOC", "Córdoba")]
+            )
+            + dataturks_line("Declaró Juan Pérez ante el juzgado.", [(["PER", "LOC"], "Juan Pérez")]),
+        )
+        self.write("b.json", dataturks_line("La señora Ana Gómez declaró.", [(["PER"], "Ana Gómez")]))
+        # the index lives among the dataturks files
+        self.connection = open_index(os.path.join(self.files_path, "index.db"))
+
+    def tearDown(self):
+        self.connection.close()
+        self.files_dir.cleanup()
+
+    def texts(self, files_path, entity):
+        return [text for text, *_ in find_concordances(self.connection, files_path, entity)]
+
+    def write(self, name, content):
+        with open(os.path.join(self.files_path, name), "w") as f:
+            f.write(content)
+
+    def test_annotation_label(self):
+        self.assertEqual(annotation_label({"label": ["PER", "LOC"]}), "PER")
+        self.assertEqual(annotation_label({"label": "LOC"}), "LOC")
+
+    def test_index_is_updated(self):
+        self.assertEqual(update_index(self.connection, self.files_path), (2, 0))
+        # unchanged files are not indexed again
+        self.assertEqual(update_index(self.connection, self.files_path), (0, 0))
+
+        os.remove(os.path.join(self.files_path, "b.json"))
+        self.write("c.json", dataturks_line("Vive en Rosario.", [(["LOC"], "Rosario")]))
+        self.assertEqual(update_index(self.connection, self.files_path), (1, 1))
+        self.assertEqual(self.texts(self.files_path, "PER"), ["Juan Pérez"])
+        self.assertEqual(self.texts(self.files_path, "LOC"), ["Córdoba", "Rosario"])
+
+    def test_index_file_is_skipped(self):
+        update_index(self.connection, self.files_path)
+        paths = [path for path, in self.connection.execute("SELECT path FROM files")]
+        self.assertEqual(sorted(os.path.basename(path) for path in paths), ["a.json", "b.json"])
+
+    def test_unparsable_files_are_skipped(self):
+        self.write("notes.txt", "these are not dataturks annotations\n")
+        self.write("other.json", json.dumps({"content": "Sin anotaciones"}) + "\n")
+        with self.assertLogs("Spacy cli concordance.py", level="WARNING") as logs:
+            self.assertEqual(update_index(self.connection, self.files_path), (2, 0))
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(self.connection.execute("SELECT id FROM documents").fetchall()), 3)
+
+    def test_first_label_is_used(self):
+        update_index(self.connection, self.files_path)
+        labels = [label for label, in self.connection.execute("SELECT label FROM annotations ORDER BY id")]
+        self.assertEqual(labels, ["PER", "LOC", "PER", "PER"])
+
+    def test_find_concordances(self):
+        update_index(self.connection, self.files_path)
+        self.assertEqual(
+            find_concordances(self.connection, self.files_path, "PER"),
+            [("Juan Pérez", "", "", 9, 18), ("Ana Gómez", "", "", 10, 18)],
+        )
+        self.assertEqual(
+            find_concordances(self.connection, self.files_path, "PER", context_words=2),
+            [("Juan Pérez", "El señor ", " vive en ", 9, 18), ("Ana Gómez", "La señora ", " declaró.", 10, 18)],
+        )
+
+
+class SharedConcordanceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        # "a_b" would match "a%b" in a LIKE pattern
+        self.paths = {name: os.path.join(self.dir.name, name) for name in ("a", "a_b", "axb")}
+        texts = {"a": "Juan Pérez", "a_b": "Ana Gómez", "axb": "Luis Díaz"}
+        for name, path in self.paths.items():
+            os.mkdir(path)
+            with open(os.path.join(path, "file.json"), "w") as f:
+                f.write(dataturks_line(f"Declaró {texts[name]} ante el juzgado.", [(["PER"], texts[name])]))
+        self.connection = open_index(os.path.join(self.dir.name, "index.db"))
+        for path in self.paths.values():
+            update_index(self.connection, path)
+
+    def tearDown(self):
+        self.connection.close()
+        self.dir.cleanup()
+
+    def texts(self, files_path, entity):
+        return [text for text, *_ in find_concordances(self.connection, files_path, entity)]
+
+    def test_concordances_of_a_directory(self):
+        self.assertEqual(self.texts(self.paths["a"], "PER"), ["Juan Pérez"])
+        self.assertEqual(self.texts(self.paths["a_b"], "PER"), ["Ana Gómez"])
+
+    def test_same_text_in_several_directories(self):
+        with open(os.path.join(self.paths["a"], "other.json"), "w") as f:
+            f.write(dataturks_line("Vive Luis Díaz en Córdoba.", [(["PER"], "Luis Díaz")]))
+        update_index(self.connection, self.paths["a"])
+        # the first occurrence of a text is looked for in the directory only
+        self.assertEqual(
+            find_concordances(self.connection, self.paths["a"], "PER", context_words=1),
+            [("Juan Pérez", "Declaró ", " ante ", 8, 17), ("Luis Díaz", "Vive ", " en ", 5, 13)],
+        )
+
+    def test_updating_a_directory_keeps_the_others(self):
+        os.remove(os.path.join(self.paths["a"], "file.json"))
+        self.assertEqual(update_index(self.connection, self.paths["a"]), (0, 1))
+        self.assertEqual(find_concordances(self.connection, self.paths["a"], "PER"), [])
+        self.assertEqual(self.texts(self.paths["axb"], "PER"), ["Luis Díaz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
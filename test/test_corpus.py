@@ -0,0 +1,264 @@
+from collections import Counter
+from corpus import (
+    aligned_entities,
+    convert_dataturks_file,
+    read_corpus,
+    read_manifest,
+    reservoir_sample,
+    resolve_overlapped_annotations,
+    split_corpus_examples,
+    split_into_windows,
+    write_jsonl_shards,
+)
+
+import json
+import os
+import random
+import spacy
+import tempfile
+import unittest
+
+
+class AlignedEntitiesTest(unittest.TestCase):
+    def setUp(self):
+        self.nlp = spacy.blank("es")
+
+    def test_misaligned_entities_are_left_out(self):
+        doc = self.nlp.make_doc("Juan Pérez vive en Córdoba.")
+        entities = [[0, 10, "PER"], [19, 23, "LOC"], [19, 26, "LOC"]]
+        self.assertEqual(aligned_entities(doc, entities), [(0, 10, "PER"), (19, 26, "LOC")])
+
+    def test_no_entities(self):
+        self.assertEqual(aligned_entities(self.nlp.make_doc("Sin entidades."), []), [])
+
+
+class ResolveOverlappedAnnotationsTest(unittest.TestCase):
+    def test_adjacent_annotations_are_kept(self):
+        annotations = [(5, 10, "LOC"), (0, 5, "PER"), (10, 12, "NUM")]
+        kept, overlapped = resolve_overlapped_annotations(annotations)
+        self.assertEqual(kept, [(0, 5, "PER"), (5, 10, "LOC"), (10, 12, "NUM")])
+        self.assertEqual(overlapped, [])
+
+    def test_contained_annotation_is_discarded(self):
+        kept, overlapped = resolve_overlapped_annotations([(0, 20, "DIRECCIÓN"), (5, 10, "NUM")])
+        self.assertEqual(kept, [(0, 20, "DIRECCIÓN")])
+        self.assertEqual(overlapped, [(5, 10, "NUM")])
+
+    def test_containing_annotation_is_kept(self):
+        kept, overlapped = resolve_overlapped_annotations([(5, 10, "NUM"), (0, 20, "DIRECCIÓN")])
+        self.assertEqual(kept, [(0, 20, "DIRECCIÓN")])
+        self.assertEqual(overlapped, [(5, 10, "NUM")])
+
+    def test_partial_overlaps_keep_the_longest(self):
+        annotations = [(0, 6, "PER"), (4, 14, "LOC"), (12, 16, "NUM"), (20, 22, "NUM")]
+        kept, overlapped = resolve_overlapped_annotations(annotations)
+        self.assertEqual(kept, [(4, 14, "LOC"), (20, 22, "NUM")])
+        self.assertEqual(overlapped, [(0, 6, "PER"), (12, 16, "NUM")])
+
+    def test_equal_length_tie_keeps_the_first(self):
+        kept, overlapped = resolve_overlapped_annotations([(3, 8, "LOC"), (0, 5, "PER")])
+        self.assertEqual(kept, [(3, 8, "LOC")])
+        self.assertEqual(overlapped, [(0, 5, "PER")])
+
+        kept, overlapped = resolve_overlapped_annotations([(0, 5, "PER"), (3, 8, "LOC")])
+        self.assertEqual(kept, [(0, 5, "PER")])
+        self.assertEqual(overlapped, [(3, 8, "LOC")])
+
+    def test_no_annotations(self):
+        self.assertEqual(resolve_overlapped_annotations([]), ([], []))
+
+
+class SplitIntoWindowsTest(unittest.TestCase):
+    def setUp(self):
+        self.text = "Declaró Juan Pérez.\nVive en Calle Falsa\n123 de Córdoba.\nNada más.\nFirmado por Ana."
+        self.entities = [
+            (self.text.index("Juan Pérez"), self.text.index("Juan Pérez") + len("Juan Pérez"), "PER"),
+            (self.text.index("Calle Falsa"), self.text.index("123") + len("123"), "DIRECCIÓN"),
+            (self.text.index("Córdoba"), self.text.index("Córdoba") + len("Córdoba"), "LOC"),
+            (self.text.index("Ana"), self.text.index("Ana") + len("Ana"), "PER"),
+        ]
+
+    def windows(self, **kwargs):
+        return list(split_into_windows(self.text, {"entities": self.entities}, **kwargs))
+
+    def test_entities_are_remapped_to_windows(self):
+        windows = self.windows(max_chars=1)
+        window_entities = [
+            (window_text[start:end], label) for window_text, annotations in windows
+            for start, end, label in annotations["entities"]
+        ]
+        original_entities = [(self.text[start:end], label) for start, end, label in self.entities]
+        self.assertEqual(window_entities, original_entities)
+
+    def test_never_cuts_inside_an_entity(self):
+        windows = self.windows(max_chars=1)
+        self.assertEqual(
+            [window_text for window_text, _ in windows],
+            ["Declaró Juan Pérez.", "Vive en Calle Falsa\n123 de Córdoba.", "Nada más.", "Firmado por Ana."],
+        )
+        self.assertEqual(windows[2][1], {"entities": []})
+
+    def test_paragraphs_are_merged_up_to_max_chars(self):
+        windows = self.windows(max_chars=len("Declaró Juan Pérez.\nVive en Calle Falsa\n123 de Córdoba.\n"))
+        self.assertEqual(
+            [window_text for window_text, _ in windows],
+            ["Declaró Juan Pérez.\nVive en Calle Falsa\n123 de Córdoba.", "Nada más.\nFirmado por Ana."],
+        )
+        self.assertEqual([len(annotations["entities"]) for _, annotations in windows], [3, 1])
+
+    def test_short_text_is_a_single_window(self):
+        windows = self.windows()
+        self.assertEqual(windows, [(self.text, {"entities": self.entities})])
+
+
+class ReservoirSampleTest(unittest.TestCase):
+    def test_sample_is_uniform(self):
+        rng = random.Random(42)
+        trials, population, size = 20000, 20, 5
+        counts = Counter()
+        for _ in range(trials):
+            sample = reservoir_sample(range(population), size, rng)
+            self.assertEqual(len(set(sample)), size)
+            counts.update(sample)
+        expected = trials * size / population
+        self.assertEqual(set(counts), set(range(population)))
+        for example, count in counts.items():
+            self.assertAlmostEqual(count / expected, 1, delta=0.05, msg=f"example {example}")
+
+    def test_short_input_returns_every_example(self):
+        self.assertEqual(reservoir_sample(iter(range(3)), 5, random.Random(0)), [0, 1, 2])
+        self.assertEqual(reservoir_sample([], 5, random.Random(0)), [])
+
+    def test_same_seed_same_sample(self):
+        self.assertEqual(
+            reservoir_sample(range(1000), 10, random.Random(7)), reservoir_sample(range(1000), 10, random.Random(7))
+        )
+
+
+class SplitCorpusExamplesTest(unittest.TestCase):
+    def setUp(self):
+        labels_by_stratum = [["PER"], ["PER", "LOC"], []]
+        sizes = [600, 300, 100]
+        self.examples = [
+            (f"texto {stratum} {i}", {"entities": [(0, 5, label) for label in labels]})
+            for stratum, (labels, size) in enumerate(zip(labels_by_stratum, sizes))
+            for i in range(size)
+        ]
+        random.Random(1).shuffle(self.examples)
+
+    def test_strata_keep_the_proportions(self):
+        proportions = [("train", 0.7), ("validation", 0.2), ("test", 0.1)]
+        splits = list(split_corpus_examples(self.examples, proportions, random.Random(3)))
+        self.assertEqual([example for _, example in splits], self.examples)
+
+        by_stratum = {}
+        for name, (_, annotations) in splits:
+            stratum = "|".join(sorted({entity[2] for entity in annotations["entities"]}))
+            by_stratum.setdefault(stratum, Counter())[name] += 1
+        self.assertEqual(set(by_stratum), {"PER", "LOC|PER", ""})
+        for stratum, counts in by_stratum.items():
+            total = sum(counts.values())
+            for name, proportion in proportions:
+                self.assertAlmostEqual(counts[name], total * proportion, delta=2, msg=f"{stratum} {name}")
+
+    def test_proportions_are_normalized(self):
+        proportions = [("a", 3), ("b", 1), ("c", 0)]
+        splits = Counter(name for name, _ in split_corpus_examples(self.examples, proportions, random.Random(5)))
+        self.assertEqual(set(splits), {"a", "b"})
+        self.assertAlmostEqual(splits["a"], 750, delta=6)
+
+
+class ConvertDataturksFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.dir.name, "cache")
+        self.line = json.dumps(
+            {
+                "content": "Vive en Córdoba.",
+                "annotation": [{"label": ["LOC"], "points": [{"start": 8, "end": 14, "text": "Córdoba"}]}],
+            }
+        )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, content):
+        path = os.path.join(self.dir.name, "file.json")
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_converted_file_is_cached(self):
+        path = self.write(self.line + "\n")
+        examples, overlapped, cached = convert_dataturks_file(path, ["LOC"], self.cache_dir)
+        self.assertEqual(examples, [("Vive en Córdoba.", {"entities": [(8, 15, "LOC")]})])
+        self.assertFalse(cached)
+        cached_examples, cached_overlapped, cached = convert_dataturks_file(path, ["LOC"], self.cache_dir)
+        self.assertTrue(cached)
+        # the same types as the uncached conversion, not JSON lists
+        self.assertEqual(cached_examples, examples)
+        self.assertEqual(type(cached_examples[0]), tuple)
+        self.assertEqual(type(cached_examples[0][1]["entities"][0]), tuple)
+        self.assertEqual(cached_overlapped, overlapped)
+
+    def test_failed_conversion_is_not_cached(self):
+        path = self.write(self.line + "\n{broken line\n" + self.line + "\n")
+        with self.assertLogs(level="ERROR"):
+            examples, _, cached = convert_dataturks_file(path, ["LOC"], self.cache_dir)
+        self.assertEqual(len(examples), 1)
+        self.assertFalse(cached)
+        self.assertFalse(os.path.isdir(self.cache_dir) and os.listdir(self.cache_dir))
+
+
+class ShardedCorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        labels = ["PER", "LOC", "PER"]
+        self.examples = [
+            [f"Texto número {i}.", {"entities": [[0, 5, label] for label in labels[: i % 4]]}] for i in range(7)
+        ]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def round_trip(self, compression):
+        corpus_dir = os.path.join(self.dir.name, f"corpus-{compression or 'plain'}")
+        manifest = write_jsonl_shards(corpus_dir, iter(self.examples), shard_size=3, compression=compression)
+        self.assertEqual(read_manifest(corpus_dir), manifest)
+
+        self.assertEqual(manifest["format"], "jsonl")
+        self.assertEqual(manifest["compression"], compression)
+        self.assertEqual(manifest["examples"], 7)
+        self.assertEqual(manifest["labels"], {"PER": 6, "LOC": 3})
+        self.assertEqual([shard["examples"] for shard in manifest["shards"]], [3, 3, 1])
+        self.assertEqual(
+            [shard["labels"] for shard in manifest["shards"]],
+            [{"PER": 2, "LOC": 1}, {"PER": 3, "LOC": 1}, {"PER": 1, "LOC": 1}],
+        )
+        shard_paths = [shard["path"] for shard in manifest["shards"]]
+        self.assertEqual(sorted(os.listdir(corpus_dir)), sorted(["manifest.json"] + shard_paths))
+        for shard in manifest["shards"]:
+            self.assertEqual(shard["bytes"], os.path.getsize(os.path.join(corpus_dir, shard["path"])))
+
+        self.assertEqual(read_corpus(corpus_dir), self.examples)
+        self.assertEqual(read_corpus(corpus_dir, workers=2), self.examples)
+        return manifest
+
+    def test_plain_round_trip(self):
+        manifest = self.round_trip("")
+        self.assertTrue(all(shard["path"].endswith(".jsonl") for shard in manifest["shards"]))
+
+    def test_gzip_round_trip(self):
+        manifest = self.round_trip("gzip")
+        self.assertTrue(all(shard["path"].endswith(".jsonl.gz") for shard in manifest["shards"]))
+
+    def test_empty_corpus(self):
+        corpus_dir = os.path.join(self.dir.name, "empty")
+        manifest = write_jsonl_shards(corpus_dir, [], shard_size=3)
+        self.assertEqual(manifest["shards"], [])
+        self.assertEqual(manifest["examples"], 0)
+        self.assertEqual(read_corpus(corpus_dir, workers=2), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
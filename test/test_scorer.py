@@ -0,0 +1,67 @@
+from scorer import EntityScorer, NONE_LABEL
+
+import unittest
+
+
+class EntityScorerTest(unittest.TestCase):
+    def setUp(self):
+        self.scorer = EntityScorer()
+        # a right PER, a LOC predicted as PER, a missing LOC and a spurious PER
+        self.scorer.add(
+            predicted=[(0, 4, "PER"), (10, 14, "LOC"), (20, 25, "PER")],
+            gold=[(0, 4, "PER"), (10, 14, "PER"), (30, 35, "LOC")],
+        )
+        # a missing PER in another doc, with the same offsets of a predicted span of the first one
+        self.scorer.add(predicted=[], gold=[(20, 25, "PER")])
+
+    def assertScores(self, scores, p, r, f):
+        self.assertAlmostEqual(scores["p"], p, places=2)
+        self.assertAlmostEqual(scores["r"], r, places=2)
+        self.assertAlmostEqual(scores["f"], f, places=2)
+
+    def test_micro_scores(self):
+        # 1 true positive out of 3 predicted and 4 gold spans
+        self.assertScores(self.scorer.scores()["micro"], 33.33, 25.0, 28.57)
+
+    def test_per_type_scores(self):
+        per_type = self.scorer.scores()["per_type"]
+        self.assertEqual(set(per_type), {"PER", "LOC"})
+        self.assertScores(per_type["PER"], 50.0, 33.33, 40.0)
+        self.assertScores(per_type["LOC"], 0.0, 0.0, 0.0)
+
+    def test_macro_scores(self):
+        # the mean of the per type scores
+        self.assertScores(self.scorer.scores()["macro"], 25.0, 16.67, 20.0)
+
+    def test_confusion(self):
+        self.assertEqual(
+            self.scorer.scores()["confusion"],
+            {
+                "PER": {"PER": 1, "LOC": 1, NONE_LABEL: 1},
+                "LOC": {NONE_LABEL: 1},
+                NONE_LABEL: {"PER": 1},
+            },
+        )
+
+    def test_confusion_table(self):
+        labels, table = self.scorer.confusion()
+        self.assertEqual(labels, ["PER", "LOC", NONE_LABEL])
+        self.assertEqual(table.tolist(), [[1, 1, 1], [0, 0, 1], [1, 0, 0]])
+
+    def test_empty_pass(self):
+        scores = EntityScorer().scores()
+        self.assertScores(scores["micro"], 0.0, 0.0, 0.0)
+        self.assertScores(scores["macro"], 0.0, 0.0, 0.0)
+        self.assertEqual(scores["per_type"], {})
+        self.assertEqual(scores["confusion"], {NONE_LABEL: {}})
+
+    def test_docs_without_entities(self):
+        scorer = EntityScorer()
+        scorer.add(predicted=[], gold=[])
+        scorer.add(predicted=[], gold=[])
+        self.assertEqual(scorer.docs, 2)
+        self.assertScores(scorer.scores()["micro"], 0.0, 0.0, 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+from corpus import iter_corpus, read_manifest, write_json_array, write_jsonl_shards
+from train import init_evaluator, _evaluator, SpacyUtils
+
+import json
+import os
+import spacy
+import tempfile
+import unittest
+
+
+class EvaluatorSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        # A blank model without labels, as it is saved before training
+        self.model_dir = tempfile.TemporaryDirectory()
+        nlp = spacy.blank("es")
+        nlp.add_pipe(nlp.create_pipe("ner"))
+        nlp.to_disk(self.model_dir.name)
+
+        # The trainer adds labels to the ner pipe and sets its shape in begin_training
+        self.nlp = spacy.blank("es")
+        ner = self.nlp.create_pipe("ner")
+        self.nlp.add_pipe(ner)
+        for label in ["PER", "LOC", "FECHA"]:
+            ner.add_label(label)
+        self.nlp.begin_training(component_cfg={"ner": {"conv_window": 3, "hidden_width": 64}})
+
+    def tearDown(self):
+        self.model_dir.cleanup()
+        _evaluator.clear()
+
+    def test_snapshot_round_trip(self):
+        init_evaluator(self.model_dir.name, {}, False)
+        ner_bytes = self.nlp.get_pipe("ner").to_bytes(exclude=["vocab"])
+        ner = _evaluator["nlp"].get_pipe("ner")
+        ner.from_bytes(ner_bytes, exclude=["vocab"])
+
+        self.assertEqual(_evaluator["nlp"].pipe_names, ["ner"])
+        self.assertEqual(sorted(ner.labels), ["FECHA", "LOC", "PER"])
+        self.assertEqual(ner.cfg["conv_window"], 3)
+        self.assertEqual(ner.cfg["hidden_width"], 64)
+
+        text = "Juan Pérez vive en Córdoba desde el 3 de marzo de 2019."
+        self.assertEqual(
+            [(ent.start_char, ent.end_char, ent.label_) for ent in _evaluator["nlp"](text).ents],
+            [(ent.start_char, ent.end_char, ent.label_) for ent in self.nlp(text).ents],
+        )
+
+
+class RemoveMisalignedAnnotationsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.model_path = os.path.join(self.dir.name, "model")
+        spacy.blank("es").to_disk(self.model_path)
+        # "Córd" and "Pér" do not match token boundaries
+        self.examples = [
+            ["Juan Pérez vive en Córdoba.", {"entities": [[0, 10, "PER"], [19, 23, "LOC"]]}],
+            ["Sin entidades.", {"entities": []}],
+            ["Declaró Ana Gómez.", {"entities": [[8, 17, "PER"]]}],
+            ["Juan Pérez declaró.", {"entities": [[5, 8, "PER"]]}],
+        ]
+        self.cleaned = [
+            ["Juan Pérez vive en Córdoba.", {"entities": [[0, 10, "PER"]]}],
+            ["Sin entidades.", {"entities": []}],
+            ["Declaró Ana Gómez.", {"entities": [[8, 17, "PER"]]}],
+            ["Juan Pérez declaró.", {"entities": []}],
+        ]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def remove_misaligned(self, input_path, **kwargs):
+        SpacyUtils().remove_misaligned_annotations_from(self.model_path, input_path, "training", **kwargs)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_json_file(self):
+        input_path = self.path("training.json")
+        write_json_array(input_path, self.examples)
+        original = self.read(input_path)
+        self.remove_misaligned(input_path, batch_size=3)
+
+        self.assertEqual(list(iter_corpus(input_path)), self.cleaned)
+        self.assertEqual(self.read(self.path("training_copy_with_misaligned.json")), original)
+        self.assertFalse(os.path.exists(self.path("training.json.tmp")))
+
+    def test_sharded_corpus(self):
+        input_path = self.path("training")
+        write_jsonl_shards(input_path, self.examples, shard_size=3, compression="")
+        self.remove_misaligned(input_path + "/", workers=2, batch_size=1)
+
+        self.assertEqual(list(iter_corpus(input_path)), self.cleaned)
+        self.assertEqual([shard["examples"] for shard in read_manifest(input_path)["shards"]], [3, 1])
+        self.assertEqual(list(iter_corpus(self.path("training_copy_with_misaligned"))), self.examples)
+        self.assertFalse(os.path.exists(self.path("training.tmp")))
+
+    def test_empty_sharded_corpus(self):
+        input_path = self.path("training")
+        write_jsonl_shards(input_path, [], compression="")
+        self.remove_misaligned(input_path)
+        self.assertEqual(read_manifest(input_path)["shards"], [])
+
+    def test_existing_backups_are_kept(self):
+        input_path = self.path("training.json")
+        write_json_array(input_path, self.examples)
+        for backup in ("training_copy_with_misaligned.json", "training_copy_with_misaligned_1.json"):
+            with open(self.path(backup), "w") as f:
+                f.write(backup)
+        original = self.read(input_path)
+        self.remove_misaligned(input_path)
+
+        self.assertEqual(list(iter_corpus(input_path)), self.cleaned)
+        self.assertEqual(self.read(self.path("training_copy_with_misaligned_2.json")), original)
+        for backup in ("training_copy_with_misaligned.json", "training_copy_with_misaligned_1.json"):
+            self.assertEqual(self.read(self.path(backup)), backup.encode())
+
+    def test_existing_sharded_backup_is_kept(self):
+        input_path = self.path("training")
+        write_jsonl_shards(input_path, self.examples, compression="")
+        write_jsonl_shards(self.path("training_copy_with_misaligned"), self.examples[:1], compression="")
+        self.remove_misaligned(input_path)
+
+        self.assertEqual(list(iter_corpus(input_path)), self.cleaned)
+        self.assertEqual(list(iter_corpus(self.path("training_copy_with_misaligned"))), self.examples[:1])
+        self.assertEqual(list(iter_corpus(self.path("training_copy_with_misaligned_1"))), self.examples)
+
+    def test_failure_leaves_the_input_untouched(self):
+        input_path = self.path("training.json")
+        # the entities of the last example can not be read
+        write_json_array(input_path, self.examples + [["Texto roto.", {"entities": None}]])
+        original = self.read(input_path)
+        with self.assertRaises(TypeError):
+            self.remove_misaligned(input_path, batch_size=2)
+
+        self.assertEqual(self.read(input_path), original)
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["model", "training.json"])
+
+    def test_failure_leaves_the_sharded_input_untouched(self):
+        input_path = self.path("training")
+        write_jsonl_shards(input_path, self.examples, shard_size=3, compression="")
+        with open(os.path.join(input_path, read_manifest(input_path)["shards"][-1]["path"]), "a") as f:
+            f.write(json.dumps(["Texto roto.", {"entities": None}]) + "\n")
+        shards = {name: self.read(os.path.join(input_path, name)) for name in os.listdir(input_path)}
+        with self.assertRaises(TypeError):
+            self.remove_misaligned(input_path, batch_size=2)
+
+        self.assertEqual({name: self.read(os.path.join(input_path, name)) for name in os.listdir(input_path)}, shards)
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["model", "training"])
+
+
+if __name__ == "__main__":
+    unittest.main()
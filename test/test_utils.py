@@ -0,0 +1,185 @@
+from spacy.gold import GoldParse
+from utils import load_checkpoint, minibatch_by_tokens, prefetch, restore_checkpoint, save_checkpoint
+
+import numpy
+import os
+import random
+import spacy
+import tempfile
+import threading
+import time
+import unittest
+
+
+LABELS = ["PER", "LOC"]
+
+
+def training_setup():
+    """
+    Returns a `(nlp, optimizer)` tuple set up as the trainer does before the
+    first epoch.
+    """
+    nlp = spacy.blank("es")
+    ner = nlp.create_pipe("ner")
+    nlp.add_pipe(ner)
+    for label in LABELS:
+        ner.add_label(label)
+    optimizer = nlp.begin_training(component_cfg={"ner": {"conv_window": 3, "hidden_width": 64}})
+    return nlp, optimizer
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "checkpoints", "train.pkl")
+
+        random.seed(1)
+        numpy.random.seed(1)
+        self.initial_random_state = random.getstate()
+        self.nlp, self.optimizer = training_setup()
+        doc = self.nlp.make_doc("Juan Pérez vive en Córdoba.")
+        gold = GoldParse(doc, entities=[(0, 10, "PER"), (19, 26, "LOC")])
+        for _ in range(2):
+            self.nlp.update([doc], [gold], sgd=self.optimizer, drop=0.2)
+
+        self.order = list(range(10))
+        random.shuffle(self.order)
+        self.state = {"i": 3, "best_f_score": 50.0, "history": {"f_score": [10.0, 30.0, 50.0]}}
+        # runtime values are not saved
+        self.state["ner_snapshot"] = b"weights"
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_checkpoint_round_trip(self):
+        save_checkpoint(self.path, self.nlp, self.optimizer, self.state, self.order, self.initial_random_state)
+        expected_random = [random.random() for _ in range(3)]
+        expected_numpy_random = numpy.random.rand(3).tolist()
+
+        # a fresh training process, with other random states
+        random.seed(2)
+        numpy.random.seed(2)
+        nlp, optimizer = training_setup()
+        state = {"i": 0, "history": {}}
+        checkpoint = load_checkpoint(self.path)
+        restore_checkpoint(checkpoint, nlp, optimizer, state)
+
+        self.assertEqual(checkpoint["order"], self.order)
+        self.assertEqual(checkpoint["initial_random_state"], self.initial_random_state)
+        self.assertEqual(state, {"i": 3, "best_f_score": 50.0, "history": {"f_score": [10.0, 30.0, 50.0]}})
+        self.assertEqual([random.random() for _ in range(3)], expected_random)
+        self.assertEqual(numpy.random.rand(3).tolist(), expected_numpy_random)
+
+        self.assertEqual(optimizer.nr_update, self.optimizer.nr_update)
+        self.assertEqual(set(optimizer.averages), set(self.optimizer.averages))
+        for key, value in self.optimizer.averages.items():
+            numpy.testing.assert_array_equal(optimizer.averages[key], value)
+        self.assertEqual(nlp.get_pipe("ner").model.to_bytes(), self.nlp.get_pipe("ner").model.to_bytes())
+        self.assertEqual(nlp.get_pipe("ner").labels, self.nlp.get_pipe("ner").labels)
+
+    def test_interrupted_write_keeps_the_previous_checkpoint(self):
+        save_checkpoint(self.path, self.nlp, self.optimizer, self.state, self.order, self.initial_random_state)
+        self.state["i"] = 4
+        self.state["unpicklable"] = lambda: None
+        with self.assertRaises(Exception):
+            save_checkpoint(self.path, self.nlp, self.optimizer, self.state, self.order, self.initial_random_state)
+        self.assertEqual(load_checkpoint(self.path)["state"]["i"], 3)
+
+
+def fake_example(length, i):
+    """
+    Returns a `(doc, gold)` stand-in: only the doc length is used to batch.
+    """
+    return (["token"] * length, i)
+
+
+class MinibatchByTokensTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.examples = [fake_example(rng.randint(1, 60), i) for i in range(200)]
+        # longer than max_tokens
+        self.examples[17] = fake_example(150, 17)
+        self.examples[123] = fake_example(101, 123)
+
+    def batches(self, seed=1, max_tokens=100, buffer=50):
+        return list(minibatch_by_tokens(self.examples, max_tokens, buffer, random.Random(seed)))
+
+    def test_padded_size_is_capped(self):
+        for batch in self.batches():
+            longest = max(len(doc) for doc, _ in batch)
+            if longest <= 100:
+                self.assertLessEqual(longest * len(batch), 100)
+
+    def test_long_docs_go_alone(self):
+        long_batches = [batch for batch in self.batches() if any(len(doc) > 100 for doc, _ in batch)]
+        self.assertEqual(sorted(batch[0][1] for batch in long_batches), [17, 123])
+        self.assertTrue(all(len(batch) == 1 for batch in long_batches))
+
+    def test_every_example_once(self):
+        batched = [i for batch in self.batches() for _, i in batch]
+        self.assertEqual(sorted(batched), list(range(200)))
+
+    def test_batches_are_shuffled_within_each_buffer(self):
+        batches = self.batches()
+        # batches of a buffer come before the ones of the next buffer
+        buffers = [max(i for _, i in batch) // 50 for batch in batches]
+        self.assertEqual([min(i for _, i in batch) // 50 for batch in batches], buffers)
+        self.assertEqual(buffers, sorted(buffers))
+
+        # and they are not sorted by length within it
+        for buffer in set(buffers):
+            lengths = [len(batch[0][0]) for batch, b in zip(batches, buffers) if b == buffer]
+            self.assertNotEqual(lengths, sorted(lengths))
+
+    def test_same_seed_same_batches(self):
+        self.assertEqual(self.batches(seed=5), self.batches(seed=5))
+        self.assertNotEqual(self.batches(seed=5), self.batches(seed=6))
+
+
+class PrefetchTest(unittest.TestCase):
+    def wait_for_threads(self, threads, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(thread.is_alive() for thread in threads):
+            time.sleep(0.05)
+        return [thread for thread in threads if thread.is_alive()]
+
+    def test_order_is_preserved(self):
+        self.assertEqual(list(prefetch(range(1000), size=3)), list(range(1000)))
+        self.assertEqual(list(prefetch([])), [])
+
+    def test_producer_exception_is_raised_in_the_consumer(self):
+        def produce():
+            yield 1
+            yield 2
+            raise KeyError("broken example")
+
+        consumed = []
+        with self.assertRaises(KeyError):
+            for item in prefetch(produce()):
+                consumed.append(item)
+        self.assertEqual(consumed, [1, 2])
+
+    def test_thread_stops_when_the_consumer_closes(self):
+        produced = []
+
+        def produce():
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+
+        before = set(threading.enumerate())
+        items = prefetch(produce(), size=2)
+        self.assertEqual([next(items) for _ in range(5)], list(range(5)))
+        threads = [thread for thread in threading.enumerate() if thread not in before]
+        self.assertEqual(len(threads), 1)
+
+        items.close()
+        self.assertEqual(self.wait_for_threads(threads), [])
+        # the producer does not run ahead more than the queue size (plus the item it was putting)
+        self.assertLessEqual(len(produced), 5 + 2 + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,20 +13,26 @@ import time
 import shutil
 import utils
 import functools
+import multiprocessing
 from spacy.util import minibatch, compounding, decaying
-from spacy.scorer import Scorer
-from spacy.gold import GoldParse
 from spacy.cli import package
+from spacy.language import Language
 import srsly
+from collections import Counter, deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
 from os import listdir
 from os.path import isfile, join
 from callbacks import (
     print_scores_on_epoch,
     save_best_model,
+    export_best_model,
     reduce_lr_on_plateau,
     early_stop,
     update_best_scores,
     sleep,
+    throttle,
     log_best_scores,
     save_csv_history,
     change_dropout_fixed,
@@ -42,6 +48,34 @@ from pipeline_components.entity_matcher import (
     fetch_cb_by_tag,
 )
 from pipeline_components.entity_custom import EntityCustom
+from concordance import open_index, update_index, find_concordances, annotation_label
+from scorer import EntityScorer
+from profiler import PipelineProfiler, format_report
+from corpus import (
+    read_dataturks_file,
+    iter_dataturks_to_spacy,
+    convert_dataturks_file,
+    dataturks_file_stats,
+    merge_stats,
+    write_json_array,
+    write_docbin,
+    write_jsonl_shards,
+    read_manifest,
+    is_sharded_corpus,
+    iter_corpus,
+    read_corpus,
+    reservoir_sample,
+    ShardWriter,
+    split_corpus_examples,
+    init_tokenizer,
+    remove_misaligned_batch,
+    get_text,
+    make_doc,
+    make_gold_example,
+    aligned_entities,
+    split_into_windows,
+    predict_batch,
+)
 
 logger = logging.getLogger("Spacy cli util")
 logger.setLevel(logging.DEBUG)
@@ -52,57 +86,108 @@ logger_fh.setFormatter(formatter)
 logger.addHandler(logger_fh)
 
 def convert_dataturks_to_spacy(dataturks_JSON_file_path, entity_list):
+    """
+    Given a dataturks .json format file and a list of entities, returns the
+    list of training examples. Documents are read lazily through
+    `corpus.iter_dataturks_to_spacy`; prefer it when the examples can be
+    consumed one at a time.
+    """
+    return list(iter_dataturks_to_spacy(dataturks_JSON_file_path, entity_list))
+
+
+# Pipeline copy and evaluation data of the asynchronous evaluation worker
+_evaluator = {}
+
+
+def init_evaluator(model_path, eval_data, save_misaligneds_to_file, batch_size=64):
+    """
+    Initializer of the evaluation worker process: loads its own copy of the
+    model with only the ner pipe enabled, as it is during training. The ner
+    pipe is a fresh one whose model is not built yet, so each snapshot builds
+    it from its own cfg (labels, conv_window, hidden_width) in from_bytes and
+    it has the shape of the trained NER.
+    """
+    nlp = spacy.load(model_path)
+    nlp.disable_pipes(*[pipe for pipe in nlp.pipe_names if pipe != "ner"])
+    if "ner" in nlp.pipe_names:
+        nlp.remove_pipe("ner")
+    nlp.add_pipe(nlp.create_pipe("ner"))
+    _evaluator.update(
+        nlp=nlp, eval_data=eval_data, save_misaligneds_to_file=save_misaligneds_to_file, batch_size=batch_size
+    )
+
+
+def evaluate_snapshot(ner_bytes, data_types, log_annotations):
+    """
+    Loads a snapshot of the NER weights in the evaluation worker pipeline and
+    returns its scores for each of the given data types.
+    """
+    nlp = _evaluator["nlp"]
+    nlp.get_pipe("ner").from_bytes(ner_bytes, exclude=["vocab"])
+    return SpacyUtils().evaluate_data_types(
+        None,
+        nlp,
+        _evaluator["eval_data"],
+        data_types,
+        _evaluator["save_misaligneds_to_file"],
+        log_annotations,
+        batch_size=_evaluator["batch_size"],
+    )
+
+
+# Full pipeline of the inference worker processes
+_inference = {}
+
+
+def register_pipeline_factories(pipelines_tag="todas"):
+    """
+    Registers the factories of the custom pipeline components, as the
+    packages built by build_model_package do, so those models can also be
+    loaded from their directory.
+    """
+    Language.factories["entity_matcher"] = lambda nlp, **cfg: EntityMatcher(
+        nlp, matcher_patterns, after_callbacks=[cb(nlp) for cb in fetch_cb_by_tag(pipelines_tag)]
+    )
+    Language.factories["entity_custom"] = lambda nlp, **cfg: EntityCustom(nlp, pipelines_tag)
+
+
+def init_inference(model_path, ready=None):
+    """
+    Initializer of the inference worker processes: loads the full pipeline
+    and waits at the `ready` barrier, when it is given, until every worker
+    has loaded it. A worker that fails to load it breaks the barrier.
+    """
     try:
-        training_data = []
-        lines = []
-
-        with open(dataturks_JSON_file_path, "r") as f:
-            lines = f.readlines()
-            count_total = 0
-            count_overlaped = 0
-            for line in lines:
-                data = json.loads(line)
-                text = data["content"]
-                entities = []
-                annotations = []
-                if data["annotation"]:
-                    for annotation in data["annotation"]:
-                        point = annotation["points"][0]
-                        label = annotation["label"]
-                        if label[0] in entity_list:
-                            annotations.append(
-                                (
-                                    point["start"],
-                                    point["end"],
-                                    label,
-                                    point["end"] - point["start"],
-                                )
-                            )
-                    annotations = sorted(annotations, key=lambda student: student[3], reverse=True)
-
-                    seen_tokens = set()
-                    for annotation in annotations:
-
-                        start = annotation[0]
-                        end = annotation[1]
-                        labels = annotation[2]
-                        if start not in seen_tokens and end - 1 not in seen_tokens:
-                            seen_tokens.update(range(start, end))
-                            if isinstance(labels, list):
-                                labels = labels[0]
-                            entities.append((start, end + 1, labels))
-                            count_total = count_total + 1
-                        else:
-                            count_overlaped = count_overlaped + 1
-                            # logger.info("{} {} {} is overlapped".format(start, end, labels))
-                training_data.append((text, {"entities": entities}))
-
-        # logger.info("Entities: {}".format(count_total))
-        # logger.info("Overlapped entities : {}".format(count_overlaped))
-        return training_data
-    except Exception as e:
-        logging.exception("Unable to process " + dataturks_JSON_file_path + "\n" + "error = " + str(e))
-        return None
+        register_pipeline_factories()
+        _inference["nlp"] = spacy.load(model_path)
+    except BaseException:
+        if ready is not None:
+            ready.abort()
+        raise
+    if ready is not None:
+        ready.wait()
+
+
+def inference_ready(_):
+    return "nlp" in _inference
+
+
+def predict_entities(examples):
+    """
+    Runs the full pipeline of an inference worker over a batch of
+    `(text, annotations)` examples. Returns a list with the predicted and
+    the aligned gold `(start, end, label)` entities and the number of tokens
+    of each text.
+    """
+    docs = _inference["nlp"].pipe([text for text, _ in examples], batch_size=len(examples))
+    return [
+        (
+            [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents],
+            aligned_entities(doc, annotations["entities"]),
+            len(doc),
+        )
+        for doc, (_, annotations) in zip(docs, examples)
+    ]
 
 
 class SpacyUtils:
@@ -182,7 +267,17 @@ class SpacyUtils:
     # =================================
 
     def convert_dataturks_to_train_file(
-        self, input_files_path: str, entities: list, output_file_path: str, num_files: int = 0
+        self,
+        input_files_path: str,
+        entities: list,
+        output_file_path: str,
+        num_files: int = 0,
+        workers: int = 1,
+        output_format: str = "json",
+        model_path: str = "",
+        shard_size: int = 10000,
+        compression: str = "gzip",
+        cache_dir: str = "",
     ):
         """
         Given an input directory and a list of entities, converts every .json
@@ -198,33 +293,163 @@ class SpacyUtils:
         :param output_file_path: The path and name of the output file.
         :param num_files An integer which means the numbers of files from
         input path to be included. 0 means all files and is default option
+        :param workers An integer with the number of processes used to convert
+        files in parallel. Documents keep the input files order. 1 by default
+        :param output_format A string with the output format: "json" (default),
+        "docbin", which writes pre-tokenized Spacy Docs (use a .spacy output
+        file) with gold entities aligned to tokens, or "jsonl", which writes
+        JSONL shards and a manifest.json into the output_file_path directory
+        :param model_path A string with the model whose tokenizer is used for
+        the "docbin" format. A blank "es" model is used when empty
+        :param shard_size An integer with the maximum number of documents by
+        shard for the "jsonl" format. 10000 by default
+        :param compression A string with the shards compression for the
+        "jsonl" format: "gzip" (default), "zstd" or "" for none
+        :param cache_dir A string with a directory where each converted file is
+        cached by content hash and entities. On reruns only new or changed
+        files are parsed. Disabled by default
         """
 
-        TRAIN_DATA = []
         begin_time = datetime.datetime.now()
         input_files = [f for f in listdir(input_files_path) if isfile(join(input_files_path, f))]
 
         if num_files == 0:
             num_files = len(input_files)
 
-        for input_file in input_files[:num_files]:
-            logger.info(f'Extracting raw data and occurrences from file: "{input_file}"...')
-            extracted_data = convert_dataturks_to_spacy(f"{input_files_path}/{input_file}", entities)
-            TRAIN_DATA = TRAIN_DATA + extracted_data
-            logger.info(f'Finished extracting data from file "{input_file}".')
+        input_files = input_files[:num_files]
+
+        overlapped_by_entities = Counter()
+
+        paths = [f"{input_files_path}/{input_file}" for input_file in input_files]
+
+        def convert_files():
+            if workers > 1:
+                logger.info(f"Extracting raw data and occurrences from {len(paths)} files using {workers} workers...")
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # map keeps the input files order whatever file finishes first
+                    yield from executor.map(convert_dataturks_file, paths, repeat(entities), repeat(cache_dir))
+            else:
+                for path in paths:
+                    yield convert_dataturks_file(path, entities, cache_dir)
+
+        def extract_examples():
+            if workers > 1 or cache_dir:
+                cached_files = 0
+                converted = convert_files()
+                for n, (input_file, (extracted_data, overlapped, cached)) in enumerate(zip(input_files, converted), 1):
+                    overlapped_by_entities.update(overlapped)
+                    cached_files += cached
+                    origin = "cache" if cached else "file"
+                    logger.info(f'Finished extracting data from {origin} "{input_file}" ({n}/{len(input_files)}).')
+                    yield from extracted_data
+                if cache_dir:
+                    logger.info(f"Reused {cached_files}/{len(input_files)} files from cache {cache_dir}.")
+            else:
+                for n, input_file in enumerate(input_files, 1):
+                    logger.info(f'Extracting raw data and occurrences from file: "{input_file}"...')
+                    yield from iter_dataturks_to_spacy(
+                        f"{input_files_path}/{input_file}", entities, overlapped_by_entities
+                    )
+                    logger.info(f'Finished extracting data from file "{input_file}" ({n}/{len(input_files)}).')
 
-        diff = datetime.datetime.now() - begin_time
-        logger.info(f"Lasted {diff} to extract dataturks data from {len(input_files)} documents.")
-        logger.info(
-            f"Converting {len(TRAIN_DATA)} Documents with Occurences extracted from {len(input_files)} files into Spacy supported format..."
-        )
         try:
             logger.info(f'💾 Writing final output at "{output_file_path}"...')
-            srsly.write_json(output_file_path, TRAIN_DATA)
+            if output_format == "docbin":
+                nlp = spacy.load(model_path) if model_path else spacy.blank("es")
+                total_docs, misaligned_by_entities = write_docbin(output_file_path, extract_examples(), nlp)
+                logger.info(f"Misaligned annotations discarded by entities: {dict(misaligned_by_entities)}.")
+            elif output_format == "jsonl":
+                manifest = write_jsonl_shards(output_file_path, extract_examples(), shard_size, compression)
+                total_docs = manifest["examples"]
+                logger.info(f"Wrote {len(manifest['shards'])} shards. Total by entities: {manifest['labels']}.")
+            else:
+                total_docs = write_json_array(output_file_path, extract_examples())
+            diff = datetime.datetime.now() - begin_time
+            logger.info(
+                f"Lasted {diff} to convert {total_docs} Documents with Occurences extracted from {len(input_files)} files into Spacy supported format."
+            )
+            logger.info(f"Overlapped annotations discarded by entities: {dict(overlapped_by_entities)}.")
             logger.info("💾 Done.")
         except Exception:
             logging.exception(f'An error occured writing the output file at "{output_file_path}".')
 
+    def corpus_stats(self, files_path: str, entities: list, output_path: str = "", workers: int = 1):
+        """
+        Given a dataturks .json format input file directory and a list of
+        entities, computes in a single (parallel) pass the corpus statistics:
+        annotations, documents and discarded overlaps by entity, entity
+        density, and text length, token count and density histograms. Writes
+        them as JSON to the output path, or prints them when it is empty.
+
+        :param files_path: Directory pointing to dataturks .json files.
+        :param entities: A list of entities, separated by comma, to be
+        considered.
+        :param output_path: The path and name of the JSON output file.
+        :param workers: An integer with the number of processes used to read
+        files in parallel. 1 by default
+        """
+        begin_time = datetime.datetime.now()
+        paths = [join(files_path, f) for f in listdir(files_path) if isfile(join(files_path, f))]
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                report = merge_stats(executor.map(dataturks_file_stats, paths, repeat(entities)))
+        else:
+            report = merge_stats(dataturks_file_stats(path, entities) for path in paths)
+        report["files"] = len(paths)
+
+        diff = datetime.datetime.now() - begin_time
+        logger.info(f"Lasted {diff} to compute stats of {report['documents']} documents from {len(paths)} files.")
+        if output_path:
+            srsly.write_json(output_path, report)
+            logger.info(f'💾 Corpus stats saved at "{output_path}".')
+        else:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    def split_corpus(
+        self,
+        input_path: str,
+        output_dir: str,
+        train: float = 0.8,
+        validation: float = 0.1,
+        test: float = 0.1,
+        seed: int = 42,
+        shard_size: int = 10000,
+        compression: str = "gzip",
+    ):
+        """
+        Given a converted corpus, streams it once and writes training,
+        validation and testing sharded corpora (see `output_format="jsonl"` in
+        convert_dataturks_to_train_file) into output_dir/training,
+        output_dir/validation and output_dir/testing. Splits are stratified by
+        the set of entity labels of each document and reproducible with the
+        given seed.
+
+        :param input_path: The path to a .json, .spacy or sharded corpus.
+        :param output_dir: The directory where the splits are written.
+        :param train: Proportion of documents for training. 0.8 by default
+        :param validation: Proportion of documents for validation. 0.1 by default
+        :param test: Proportion of documents for testing. 0.1 by default
+        :param seed: Random seed. 42 by default
+        :param shard_size: Maximum number of documents by shard. 10000 by default
+        :param compression: Shards compression: "gzip" (default), "zstd" or ""
+        """
+        nlp = spacy.blank("es") if input_path.endswith(".spacy") else None
+        proportions = [("training", train), ("validation", validation), ("testing", test)]
+        writers = {
+            name: ShardWriter(join(output_dir, name), shard_size, compression)
+            for name, proportion in proportions
+            if proportion > 0
+        }
+        rng = random.Random(seed)
+        for name, example in split_corpus_examples(iter_corpus(input_path, nlp), proportions, rng):
+            writers[name].write(example)
+
+        for name, writer in writers.items():
+            manifest = writer.close()
+            logger.info(f'💾 {name} split: {manifest["examples"]} documents, entities {manifest["labels"]}.')
+            print(f'{name}: {manifest["examples"]} documents saved in {join(output_dir, name)}')
+
     def calculate_by_entity(self, totalizer, entities):
         for span in entities:
             try:
@@ -233,62 +458,94 @@ class SpacyUtils:
                 totalizer[span[2]] = 1
 
 
-    def remove_misaligned_annotations_from(self, model_path: str, input_files_path: str, data_type: str):
+    def remove_misaligned_annotations_from(
+        self, model_path: str, input_files_path: str, data_type: str, workers: int = 1, batch_size: int = 256
+    ):
         """
-        Given a Spacy model path, a data file path and a data type (it should be one of: training, validation, testing), 
-        removes misaligned annotations to the given file and updates the model to the given path.
-        Before removing misaligned annotations, it creates a copy of the involved file.
+        Given a Spacy model path, a data file path and a data type (it should be one of: training, validation, testing),
+        removes misaligned annotations to the given file. An annotation is misaligned when its offsets do not
+        match the model tokenizer token boundaries. Only the tokenizer is used, in batches that can be spread
+        over worker processes, and the cleaned data is written while it is being processed.
+        The original data is kept as a copy of the involved file (or sharded corpus directory).
 
         :param model_path: A model path
-        :param input_files_path: A input file path to be "depured"
+        :param input_files_path: A input file path to be "depured": a .json file or a sharded corpus directory
         :param data_type: file data type (it should be one of: training, validation, testing)
+        :param workers: number of processes used to tokenize batches. 1 by default
+        :param batch_size: number of documents by batch. 256 by default
         """
 
-        #we create a backup copy of the file to be modified
-        dest = input_files_path.replace('.json', f'_copy_with_misaligned.json')
-        orig = input_files_path
-        shutil.copyfile(orig, dest)
+        if input_files_path.endswith(".spacy"):
+            logger.info(f"{input_files_path} annotations were aligned to tokens during conversion.")
+            return
 
         nlp = spacy.load(model_path)
 
-        misaligned_docs_qty = 0
-        misaligned_lost_by_entities = {}
-        only_misaligneds = 0
-        total_lost_misaligned = 1
-
-        with open(input_files_path, 'r') as f:
-            data = json.load(f)
-
-            for text, annotations in data:
-                doc_gold_text = nlp.make_doc(text)
-                annotation_ents = annotations.get('entities')
-                alignment_values = spacy.gold.biluo_tags_from_offsets(doc_gold_text, annotation_ents)
-                is_misaligned_doc = True if '-' in alignment_values else False
-                if is_misaligned_doc:
-                    text_array = nlp(text)
-                    misaligned_texts = self.get_misaligned_texts(alignment_values, text_array)
-                    for i, annot in enumerate(annotation_ents):
-                        annotation_text = str(text[annot[0]:annot[1]])
-                        if any(annotation_text.replace(' ', '') in text for text in misaligned_texts):
-                            # print(f"annotation_text {annotation_text}")
-                            # print(f"esta MAL la annotation: {annot} con idx: {i}")
-                            annotation_ents.pop(i)
-                            only_misaligneds = only_misaligneds + 1
-
-                    misaligned_docs_qty = misaligned_docs_qty + 1
-                    self.calculate_by_entity(misaligned_lost_by_entities, annotation_ents)
-
-            with open(input_files_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+        stats = Counter()
+        misaligned_lost_by_entities = Counter()
+
+        def batches():
+            batch = []
+            for example in iter_corpus(input_files_path, nlp):
+                batch.append(example)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def cleaned_examples(processed_batches):
+            for batch, aligned_batch in processed_batches:
+                for (text, annotations), aligned in zip(batch, aligned_batch):
+                    entities = annotations.get("entities")
+                    stats["docs"] += 1
+                    if len(aligned) < len(entities):
+                        stats["misaligned_docs"] += 1
+                        stats["misaligned_docs_entities"] += len(entities)
+                        stats["removed"] += len(entities) - len(aligned)
+                        misaligned_lost_by_entities.update(entity[2] for entity in entities)
+                    yield (text, {**annotations, "entities": aligned})
+
+        def write_cleaned(processed_batches):
+            if is_sharded_corpus(input_files_path):
+                manifest = read_manifest(input_files_path)
+                # an empty corpus has no shards
+                shard_size = max((shard["examples"] for shard in manifest["shards"]), default=10000)
+                write_jsonl_shards(tmp_path, cleaned_examples(processed_batches), shard_size, manifest["compression"])
+            else:
+                write_json_array(tmp_path, cleaned_examples(processed_batches))
 
-            if misaligned_docs_qty:
-                total_lost_misaligned = functools.reduce(lambda a,b: a+b, misaligned_lost_by_entities.values())
+        input_path = input_files_path.rstrip("/")
+        tmp_path = f"{input_path}.tmp"
 
-            print(f'\n\nMisaligned docs for {data_type} data: {misaligned_docs_qty}/{len(data)} ({round(100*misaligned_docs_qty/len(data),2)}%).')
-            print(f'Entities that could be lost because of misaligned: {total_lost_misaligned}.')
-            print(f'Misaligned annotations removed: {only_misaligneds} ({round(only_misaligneds/total_lost_misaligned*100, 2)}% of total entities in related docs).')
-            print(f'Data without misaligned annotations saved in:  {input_files_path}')
+        # we keep a backup copy of the modified data, without overwriting the
+        # backups of previous runs
+        dest = utils.backup_path(input_path)
 
+        # leftovers of an interrupted run
+        utils.remove_path(tmp_path)
+        try:
+            if workers > 1:
+                tokenizer_init = (nlp.lang, nlp.tokenizer.to_bytes())
+                with ProcessPoolExecutor(
+                    max_workers=workers, initializer=init_tokenizer, initargs=tokenizer_init
+                ) as executor:
+                    write_cleaned(utils.bounded_map(executor, remove_misaligned_batch, batches(), 2 * workers))
+            else:
+                write_cleaned((batch, remove_misaligned_batch(batch, nlp.tokenizer)) for batch in batches())
+            os.replace(input_path, dest)
+        except BaseException:
+            utils.remove_path(tmp_path)
+            raise
+        os.replace(tmp_path, input_path)
+
+        docs_qty = stats["docs"] or 1
+        total_lost_misaligned = stats["misaligned_docs_entities"] or 1
+        print(f'\n\nMisaligned docs for {data_type} data: {stats["misaligned_docs"]}/{stats["docs"]} ({round(100*stats["misaligned_docs"]/docs_qty,2)}%).')
+        print(f'Entities that could be lost because of misaligned: {stats["misaligned_docs_entities"]} {dict(misaligned_lost_by_entities)}.')
+        print(f'Misaligned annotations removed: {stats["removed"]} ({round(stats["removed"]/total_lost_misaligned*100, 2)}% of total entities in related docs).')
+        print(f'Data without misaligned annotations saved in:  {input_files_path}')
+        print(f'Original data saved in:  {dest}')
 
     # =================================
     # Model Training functions
@@ -307,6 +564,9 @@ class SpacyUtils:
         callbacks={},
         settings={},
         disabled_pipes=[],
+        model_path="",
+        checkpoint=None,
+        initial_random_state=None,
     ):
         init_time = time.time()
         print("\nsettings", settings)
@@ -317,24 +577,29 @@ class SpacyUtils:
             "train_size": len(training_data),
             "history": {
                 "ner": [],
-                "f_score": [],
+                "f_score": [],  # micro averaged
+                "macro_f_score": [],
                 "recall": [],
                 "precision": [],
                 "per_type_score": [],
                 "val_f_score": [],
+                "val_macro_f_score": [],
                 "val_recall": [],
                 "val_precision": [],
                 "val_per_type_score": [],
                 "lr": [],
                 "batches": [],  # processed batches
+                "samples": [],  # training examples seen
                 "dropout": [],
                 "saved": [],
             },
             "min_ner": 0,
             "max_f_score": 0,
+            "max_macro_f_score": 0,
             "max_recall": 0,
             "max_precision": 0,
             "max_val_f_score": 0,
+            "max_val_macro_f_score": 0,
             "max_val_recall": 0,
             "max_val_precision": 0,
             "lr": optimizer.learn_rate,
@@ -344,39 +609,76 @@ class SpacyUtils:
             "evaluate_test": False,
         }
 
-        # for validation. activate if exists validation data
-        if settings["evaluate"] == "val":
-            val_texts, val_annotations = zip(*validation_data)
+        eval_data = self.get_eval_data(nlp, training_data, validation_data, testing_data, settings)
+        val_every = settings.get("val_every", 1)
+
+        # With async_eval > 0, a worker process with its own copy of the
+        # pipeline evaluates each epoch while the next ones train. Epochs are
+        # finished (history and on_iteration callbacks) when their scores
+        # arrive, at most async_eval epochs later
+        # predictions run in batches, optionally in several processes
+        eval_args = {"batch_size": settings.get("eval_batch_size", 64), "n_process": settings.get("eval_processes", 1)}
+        async_eval = settings.get("async_eval", 0)
+        evaluator = None
+        pending = deque()
+        if async_eval > 0:
+            evaluator = ProcessPoolExecutor(
+                max_workers=1,
+                initializer=init_evaluator,
+                initargs=(model_path, eval_data, save_misaligneds_to_file, eval_args["batch_size"]),
+            )
 
-        if len(testing_data) > 0:
-            test_texts, test_annotations = zip(*testing_data)
+        # what finishing an epoch needs, besides the state
+        run = {
+            "nlp": nlp,
+            "optimizer": optimizer,
+            "settings": settings,
+            "callbacks": callbacks,
+            "disabled_pipes": disabled_pipes,
+            "evaluator": evaluator,
+            "eval_data": eval_data,
+            "eval_args": eval_args,
+            "save_misaligneds_to_file": save_misaligneds_to_file,
+        }
 
-        tr_texts, tr_annotations = zip(*training_data)
+        # Docs and gold parses are built once, so epochs do not tokenize and
+        # align the same texts again
+        logger.info("Building training docs and gold parses")
+        train_examples = [make_gold_example(nlp, text, annotations) for text, annotations in training_data]
+
+        # Examples (or windows) without entities are subsampled each epoch
+        negative_sampling = settings.get("negative_sampling", 1)
+        positives = [e for e, (_, a) in zip(train_examples, training_data) if a.get("entities")]
+        negatives = [e for e, (_, a) in zip(train_examples, training_data) if not a.get("entities")]
+
+        # periodic checkpoints to resume the training (see the resume flag of train)
+        checkpoint_every = settings.get("checkpoint_every", 0)
+        example_indexes = {id(example): i for i, example in enumerate(train_examples)}
+        if checkpoint is not None:
+            utils.restore_checkpoint(checkpoint, nlp, optimizer, state)
+            train_examples[:] = [train_examples[i] for i in checkpoint["order"]]
+            init_time -= state["elapsed_time"] * 60
+            logger.info(f"Resuming training from epoch {state['i'] + 1}")
 
         while not state["stop"] and state["i"] < state["epochs"]:
+            if negative_sampling < 1:
+                epoch_examples = positives + random.sample(negatives, round(len(negatives) * negative_sampling))
+                logger.info(f"Training on {len(epoch_examples)} of {len(train_examples)} examples")
+            else:
+                epoch_examples = train_examples
             # Randomizes training data
-            random.shuffle(training_data)
+            random.shuffle(epoch_examples)
             losses = {}
 
             # set/update Adam optimizer from state
             optimizer.learn_rate = state["lr"]
 
-            if len(settings["batch_args"]) > 0:
-                batch_size = settings["batch_size"](*settings["batch_args"])
-            else:
-                batch_size = settings["batch_size"]
-
-            # Creates mini batches
-            batches = minibatch(training_data, size=batch_size)
             num_batches = 0
-            # bz = []
-            for batch in batches:
+            for docs, golds in self.get_epoch_batches(epoch_examples, settings):
                 num_batches += 1
-                texts, annotations = zip(*batch)
-                # bz.append(len(texts))
                 nlp.update(
-                    texts,  # batch of raw texts
-                    annotations,  # batch of annotations
+                    docs,  # batch of tokenized docs
+                    golds,  # batch of gold parses
                     drop=state["dropout"],
                     losses=losses,
                     sgd=optimizer,
@@ -386,88 +688,215 @@ class SpacyUtils:
                 for cb in callbacks["on_batch"]:
                     state = cb(state, logger, nlp, optimizer, disabled_pipes)
             log_annotations = True if state["i"] == 0 else False
-            try:
-                # compute validation scores
-                val_f_score, val_precision_score, val_recall_score, val_per_type_score = -1, -1, -1, -1
-                if settings["evaluate"] == "val":
-                    logger.info("Evaluating docs from validation data")
-                    val_f_score, val_precision_score, val_recall_score, val_per_type_score = self.evaluate_multiple(
-                        optimizer, nlp, val_texts, val_annotations, "validation", save_misaligneds_to_file, log_annotations
-                    )
+            data_types = []
+            if "validation" in eval_data and (state["i"] + 1) % val_every == 0:
+                data_types.append("validation")
+            if "training" in eval_data:
+                data_types.append("training")
+            epoch = {
+                "i": state["i"],
+                "ner": losses.get("ner"),
+                "lr": optimizer.learn_rate,
+                "batches": num_batches,
+                "dropout": state["dropout"],
+                "samples": len(epoch_examples),
+            }
 
-                # train data score
-                logger.info("Evaluating docs from training data")
-                f_score, precision_score, recall_score, per_type_score = self.evaluate_multiple(
-                    optimizer, nlp, tr_texts, tr_annotations, "training", save_misaligneds_to_file, log_annotations
+            if evaluator is None:
+                scores = self.evaluate_data_types(
+                    optimizer, nlp, eval_data, data_types, save_misaligneds_to_file, log_annotations, **eval_args
                 )
+                state = self.finish_epoch(state, epoch, scores, run)
+            else:
+                # the averaged NER weights are evaluated by the worker while the next epoch trains
+                with nlp.use_params(optimizer.averages):
+                    epoch["ner_bytes"] = nlp.get_pipe("ner").to_bytes(exclude=["vocab"])
+                future = evaluator.submit(evaluate_snapshot, epoch["ner_bytes"], data_types, log_annotations)
+                pending.append((epoch, future))
+                state = self.finish_evaluated_epochs(state, pending, run, max_pending=async_eval)
 
-                numero_losses = losses.get("ner")
-
-            except Exception as e:
-                logger.exception("The batch has no training data.")
-
-            utils.save_state_history(
-                state,
-                numero_losses,
-                f_score,
-                recall_score,
-                precision_score,
-                per_type_score,
-                val_f_score,
-                val_recall_score,
-                val_precision_score,
-                val_per_type_score,
-                optimizer.learn_rate,
-                num_batches,
-                state["dropout"],
-            )
-
-            # run callbacks after each iteration
-
-            for cb in callbacks["on_iteration"]:
-                state = cb(state, logger, nlp, optimizer, disabled_pipes)
+            state["i"] += 1
 
-            # compute testing dataset scores
-            # Since we can save many models if some threshold has been reached
-            # during the train loop. We also want to get scores on test data
-            # for each one of this models.
-            if settings["evaluate"] == "test" and state["evaluate_test"]:
-                logger.info("Evaluating docs from testing data")
-                test_f_score, test_precision_score, test_recall_score, test_per_type_score = self.evaluate_multiple(
-                    optimizer, nlp, test_texts, test_annotations, "test", save_misaligneds_to_file, log_annotations
+            if checkpoint_every > 0 and state["i"] % checkpoint_every == 0:
+                # pending epochs are finished so the checkpoint has their history
+                state = self.finish_evaluated_epochs(state, pending, run)
+                state["elapsed_time"] = (time.time() - init_time) / 60
+                order = [example_indexes[id(example)] for example in train_examples]
+                utils.save_checkpoint(
+                    settings["checkpoint_path"], nlp, optimizer, state, order, initial_random_state
                 )
-                logger.info("############################################################")
-                logger.info("Evaluating saved model with test data")
-                logger.info(f"Scores :f1-score: {test_f_score}, precision: {test_precision_score}")
-                logger.info(f"{test_per_type_score}")
-                logger.info("############################################################")
 
-            state["evaluate_test"] = False
-            state["i"] += 1
+        # epochs trained while their evaluation was pending
+        state = self.finish_evaluated_epochs(state, pending, run)
+        if evaluator is not None:
+            evaluator.shutdown()
 
         # Run callbacks after train loop
         state["elapsed_time"] = (time.time() - init_time) / 60
         for cb in callbacks["on_stop"]:
             state = cb(state, logger, nlp, optimizer, disabled_pipes)
 
-    def train(self, config: str):
+    def get_eval_data(self, nlp, training_data, validation_data, testing_data, settings):
+        """
+        Returns a dict of `data_type: (texts, annotations, diagnostics)` with
+        the evaluated corpora: validation (when it is evaluated), a fixed
+        stratified sample of training data of `train_eval_size` examples (or
+        all of it, or none when it is 0) and test data. Gold alignment
+        diagnostics are computed once for each corpus.
+        """
+        train_eval_size = settings.get("train_eval_size", -1)
+        train_eval_data = training_data
+        if 0 <= train_eval_size < len(training_data):
+            proportions = [("sample", train_eval_size), ("rest", len(training_data) - train_eval_size)]
+            sampled = split_corpus_examples(training_data, proportions, random)
+            train_eval_data = [example for name, example in sampled if name == "sample"]
+            logger.info(f"Evaluating training data on a sample of {len(train_eval_data)} texts")
+
+        corpora = {"training": train_eval_data, "test": testing_data}
+        if settings["evaluate"] == "val":
+            corpora = {"validation": validation_data, **corpora}
+        eval_data = {}
+        for data_type, examples in corpora.items():
+            if len(examples) > 0:
+                texts, annotations = zip(*examples)
+                eval_data[data_type] = (texts, annotations, self.alignment_diagnostics(nlp, texts, annotations))
+        return eval_data
+
+    def get_epoch_batches(self, epoch_examples, settings):
+        """
+        Returns an iterator of `(docs, golds)` batches of the epoch examples.
+        Batchers (e.g. token_budget) build their own with a random generator
+        seeded here, as they run in another thread. Batches are prepared in
+        background while the model updates when `prefetch` is over 0.
+        """
+        if len(settings["batch_args"]) > 0:
+            batch_size = settings["batch_size"](*settings["batch_args"])
+        else:
+            batch_size = settings["batch_size"]
+
+        if callable(batch_size):
+            batches = batch_size(epoch_examples, rng=random.Random(random.getrandbits(32)))
+        else:
+            batches = minibatch(epoch_examples, size=batch_size)
+        batches = (zip(*batch) for batch in batches)
+        if settings.get("prefetch", 2) > 0:
+            batches = utils.prefetch(batches, settings.get("prefetch", 2))
+        return batches
+
+    def finish_evaluated_epochs(self, state, pending, run, max_pending=0):
+        """
+        Finishes the epochs of the `pending` deque of `(epoch, future)`
+        asynchronous evaluations, oldest first, while they are done or there
+        are more than `max_pending` of them. With 0 it waits for all of them.
+        """
+        while pending and (pending[0][1].done() or len(pending) > max_pending):
+            epoch, future = pending.popleft()
+            state = self.finish_epoch(state, epoch, future.result(), run)
+        return state
+
+    def finish_epoch(self, state, epoch, scores, run):
+        """
+        Saves the epoch in the history and runs the on_iteration callbacks.
+        While they run state["i"] is the finished epoch, which can be older
+        than the trained one.
+        """
+        settings, nlp, optimizer = run["settings"], run["nlp"], run["optimizer"]
+        trained = state["i"]
+        state["i"] = epoch["i"]
+        # validation scores of epochs without evaluation are None
+        no_val_scores = (None, None, None, None, None) if settings["evaluate"] == "val" else (-1, -1, -1, -1, -1)
+        f_score, precision_score, recall_score, per_type_score, macro_f_score = scores.get(
+            "training", (None, None, None, None, None)
+        )
+        val_f_score, val_precision_score, val_recall_score, val_per_type_score, val_macro_f_score = scores.get(
+            "validation", no_val_scores
+        )
+        utils.save_state_history(
+            state,
+            epoch["ner"],
+            f_score,
+            recall_score,
+            precision_score,
+            per_type_score,
+            val_f_score,
+            val_recall_score,
+            val_precision_score,
+            val_per_type_score,
+            epoch["lr"],
+            epoch["batches"],
+            epoch["dropout"],
+            epoch["samples"],
+            macro_f_score,
+            val_macro_f_score,
+        )
+
+        # lightweight checkpoints use the evaluated weights, not the current ones
+        if "ner_bytes" in epoch:
+            state["ner_snapshot"] = epoch["ner_bytes"]
+
+        # run callbacks after each iteration
+        for cb in run["callbacks"]["on_iteration"]:
+            state = cb(state, logger, nlp, optimizer, run["disabled_pipes"])
+        state.pop("ner_snapshot", None)
+
+        # compute testing dataset scores
+        # Since we can save many models if some threshold has been reached
+        # during the train loop. We also want to get scores on test data
+        # for each one of this models.
+        if settings["evaluate"] == "test" and state["evaluate_test"]:
+            self.evaluate_test_data(epoch, run)
+
+        state["evaluate_test"] = False
+        state["i"] = trained
+        return state
+
+    def evaluate_test_data(self, epoch, run):
+        """
+        Logs the test data scores of an epoch, with its evaluated snapshot
+        when it was evaluated asynchronously.
+        """
+        logger.info("Evaluating docs from testing data")
+        if "ner_bytes" in epoch:
+            test_scores = run["evaluator"].submit(evaluate_snapshot, epoch["ner_bytes"], ["test"], False).result()
+        else:
+            test_scores = self.evaluate_data_types(
+                run["optimizer"],
+                run["nlp"],
+                run["eval_data"],
+                ["test"],
+                run["save_misaligneds_to_file"],
+                False,
+                **run["eval_args"],
+            )
+        test_f_score, test_precision_score, test_recall_score, test_per_type_score, _ = test_scores["test"]
+        logger.info("############################################################")
+        logger.info("Evaluating saved model with test data")
+        logger.info(f"Scores :f1-score: {test_f_score}, precision: {test_precision_score}")
+        logger.info(f"{test_per_type_score}")
+        logger.info("############################################################")
+
+    def train(self, config: str, resume: bool = False):
         """
         Runs the train_model method using the selected configuration from train_config.json
         :param config the train configuration name
+        :param resume when true continues the training from the last checkpoint
         """
         FUNC_MAP = {
             "save_best_model": save_best_model,
+            "export_best_model": export_best_model,
             "reduce_lr_on_plateau": reduce_lr_on_plateau,
             "early_stop": early_stop,
             "update_best_scores": update_best_scores,
             "log_best_scores": log_best_scores,
             "save_csv_history": save_csv_history,
             "sleep": sleep,
+            "throttle": throttle,
             "print_scores_on_epoch": print_scores_on_epoch,
             "change_dropout_fixed": change_dropout_fixed,
             # spacy funcs
             "compounding": compounding,
             "decaying": decaying,
+            "token_budget": utils.token_budget,
         }
         try:
             with open("train_config.json") as f:
@@ -494,6 +923,18 @@ class SpacyUtils:
             if "path_data_testing" in train_config:
                 test_ds = train_config["path_data_testing"]
 
+            loader_workers = train_config.get("loader_workers", 1)
+            window = train_config.get("window", {})
+            negative_sampling = train_config.get("negative_sampling", 1)
+            prefetch = train_config.get("prefetch", 2)
+            train_eval_size = train_config.get("train_eval_size", -1)
+            val_every = train_config.get("val_every", 1)
+            async_eval = train_config.get("async_eval", 0)
+            eval_batch_size = train_config.get("eval_batch_size", 64)
+            eval_processes = train_config.get("eval_processes", 1)
+            checkpoint_every = train_config.get("checkpoint_every", 0)
+            checkpoint_path = train_config.get("checkpoint_path", f"checkpoints/{config}.pkl")
+
             # train settings
             dropout = utils.set_dropout(train_config, FUNC_MAP)
             batch_size, batch_args = utils.set_batch_size(train_config, FUNC_MAP)
@@ -510,6 +951,15 @@ class SpacyUtils:
                 "batch_size": batch_size,
                 "batch_args": batch_args,
                 "evaluate": evaluate,
+                "negative_sampling": negative_sampling,
+                "prefetch": prefetch,
+                "train_eval_size": train_eval_size,
+                "val_every": val_every,
+                "async_eval": async_eval,
+                "eval_batch_size": eval_batch_size,
+                "eval_processes": eval_processes,
+                "checkpoint_every": checkpoint_every,
+                "checkpoint_path": checkpoint_path,
             }
 
             on_iter_cb = []
@@ -545,6 +995,9 @@ class SpacyUtils:
             callbacks=c,
             settings=s,
             train_subset=train_config["train_subset"],
+            loader_workers=loader_workers,
+            window=window,
+            resume=resume,
         )
 
     def train_model(
@@ -562,6 +1015,9 @@ class SpacyUtils:
         callbacks={},
         settings={},
         train_subset=0,
+        loader_workers: int = 1,
+        window={},
+        resume: bool = False,
     ):
         """
         Given a dataturks .json format input file, a list of entities and a path
@@ -580,41 +1036,69 @@ class SpacyUtils:
         :param max_losses: A float representing the maximum NER losses value
         to consider before start writing best models output.
         :param is_raw A boolean that determines if the train file will be converted        True by default
+        :param loader_workers An integer with the number of processes used to
+        read the shards of sharded corpora. 1 by default
+        :param window A dict like {"by": "paragraph", "max_chars": 2000} to
+        split training docs into paragraph or sentence windows. Empty (docs
+        are not split) by default
+        :param resume A boolean to continue the training from the checkpoint at
+        settings["checkpoint_path"]. False by default
         """
 
-        if is_raw:
-            logger.info(f"loading and converting training data from dataturks: {path_data_training}")
-            training_data = convert_dataturks_to_spacy(path_data_training, ents)
-
-            if path_data_validation != "":
-                logger.info(f"loading and converting validation data from dataturks: {path_data_training}")
-                validation_data = convert_dataturks_to_spacy(path_data_training, ents)
+        nlp = spacy.load(model_path)
 
+        checkpoint = None
+        if resume:
+            logger.info(f"Loading checkpoint {settings['checkpoint_path']}")
+            checkpoint = utils.load_checkpoint(settings["checkpoint_path"])
+            # same random draws as the interrupted run, so the same training data is sampled
+            random.setstate(checkpoint["initial_random_state"])
+        initial_random_state = random.getstate()
+
+        def load_examples(data_type, path, stream=False):
+            if is_raw:
+                # Dataturks lines are parsed one at a time, only converted examples are kept
+                logger.info(f"loading and converting {data_type} data from dataturks: {path}")
+                return iter_dataturks_to_spacy(path, ents) if stream else convert_dataturks_to_spacy(path, ents)
+            # .spacy corpora are loaded as pre-tokenized Docs and sharded
+            # corpora are streamed shard by shard
+            logger.info(f"loading pre-converted {data_type} data: {path}")
+            return iter_corpus(path, nlp) if stream else read_corpus(path, nlp, loader_workers)
+
+        validation_data = []
+        if path_data_validation != "":
+            validation_data = load_examples("validation", path_data_validation)
+
+        testing_data = []
+        if path_data_testing != "":
+            testing_data = load_examples("testing", path_data_testing)
+
+        if train_subset > 0:
+            # reservoir sampling streams the training data instead of loading it
+            training_examples = load_examples("training", path_data_training, stream=True)
             if path_data_testing != "":
-                logger.info(f"loading and converting testing data from dataturks: {path_data_training}")
-                testing_data = convert_dataturks_to_spacy(path_data_testing, ents)
+                # mix train and validation data
+                training_examples = chain(training_examples, validation_data)
+            training_data = reservoir_sample(training_examples, train_subset, random)
+            logger.info(f"Using a random subset of {len(training_data)} texts")
         else:
-            logger.info(f"loading pre-converted training data JSON: {path_data_training}")
-            with open(path_data_training) as f:
-                training_data = json.load(f)
-
-            if path_data_validation != "":
-                logger.info(f"loading pre-converted validation data JSON: {path_data_validation}")
-                with open(path_data_validation) as f:
-                    validation_data = json.load(f)
-
+            training_data = load_examples("training", path_data_training)
             if path_data_testing != "":
-                logger.info(f"loading pre-converted testing data JSON: {path_data_testing}")
-                with open(path_data_testing) as f:
-                    testing_data = json.load(f)
                 # mix train and validation data
                 training_data += validation_data
-            else:
-                testing_data = []
+
+        if window:
+            # long docs are split so updates work on bounded-size examples
+            total_docs = len(training_data)
+            training_data = [
+                example
+                for text, annotations in training_data
+                for example in split_into_windows(text, annotations, **window)
+            ]
+            logger.info(f"Split {total_docs} training docs into {len(training_data)} windows")
 
         # print("total data: ", len(training_data))
 
-        nlp = spacy.load(model_path)
         # Filters pipes to disable them during training
         pipe_exceptions = ["ner"]
         other_pipes = [pipe for pipe in nlp.pipe_names if pipe not in pipe_exceptions]
@@ -649,23 +1133,17 @@ class SpacyUtils:
             # these are default callbacks
             if not bool(callbacks):
                 callbacks = {
-                    "on_batch": [sleep(secs=1)],
+                    "on_batch": [throttle()],
                     "on_iteration": [
                         print_scores_on_epoch(),
-                        save_best_model(path_best_model=path_best_model, threshold=max_losses),
+                        save_best_model(path_best_model=path_best_model, threshold=max_losses, lightweight=True),
                         reduce_lr_on_plateau(epochs=3, diff=1, step=0.001),
                         early_stop(epochs=10, diff=2),
                         update_best_scores(),
-                        sleep(secs=3, log=True),
                     ],
-                    "on_stop": [log_best_scores(), save_csv_history()],
+                    "on_stop": [export_best_model(), log_best_scores(), save_csv_history()],
                 }
 
-            # TODO default settings just in case not using train_config.json
-            if train_subset > 0:
-                training_data = random.sample(training_data, train_subset)
-                logger.info(f"Using a random subset of {train_subset} texts")
-
             self.get_best_model(
                 optimizer,
                 nlp,
@@ -678,6 +1156,9 @@ class SpacyUtils:
                 callbacks=callbacks,
                 settings=settings,
                 disabled_pipes=disabled_pipes,
+                model_path=model_path,
+                checkpoint=checkpoint,
+                initial_random_state=initial_random_state,
             )
 
     # =================================
@@ -697,29 +1178,6 @@ class SpacyUtils:
         doc = nlp(text)
         spacy.displacy.serve(doc, style="ent", page=True, port=5030)
 
-    def evaluate(self, nlp, text: str, entity_ocurrences: list):
-        """
-        Given a path to an existent Spacy model, a raw text and a list of
-        entity occurences, computes a Spacy model score to return the Scorer
-        scores.
-
-        :param model_path: A string representing the directory of an existent
-        Spacy model.
-        :param text: A raw text to use as evaluation data.
-        :param entity_occurences: A list of entity occurrences.
-        """
-        scorer = Scorer()
-        try:
-            doc_gold_text = nlp.make_doc(text)
-            alignment_values = spacy.gold.biluo_tags_from_offsets(doc_gold_text, entity_ocurrences.get("entities"))
-            is_misaligned_doc = True if '-' in alignment_values else False
-            gold = GoldParse(doc_gold_text, entities=entity_ocurrences.get("entities"))
-            pred_value = nlp(text)
-            scorer.score(pred_value, gold)
-            return scorer.scores, is_misaligned_doc, alignment_values
-        except Exception as e:
-            print(e)
-
     def get_misaligned_texts(self, misaligned_array, text_array):
         """
         Given a list of alignment values for a doc and an array with the tokenized doc, 
@@ -777,14 +1235,17 @@ class SpacyUtils:
         data = []
         total_misaligneds = 0
         for i in range(len(misaligned_docs)):
-            text_raw = misaligned_docs[i]["text"]
-            text_array = nlp(text_raw)
+            text_raw = get_text(misaligned_docs[i]["text"])
             #to check how the doc is being tokenized and understand why the misaligned warning is arising
             # if "validation" in filename: 
                 # tok_exp = nlp.tokenizer.explain(text_raw)
                 # for t in tok_exp:
                     # print(t[1], "\t", t[0])
-            misaligned_texts = self.get_misaligned_texts(misaligned_docs[i]["alignment_values"], text_array)
+            if "misaligned_texts" in misaligned_docs[i]:
+                misaligned_texts = misaligned_docs[i]["misaligned_texts"]
+            else:
+                doc = make_doc(nlp, misaligned_docs[i]["text"])
+                misaligned_texts = self.get_misaligned_texts(misaligned_docs[i]["alignment_values"], doc)
             total_misaligneds = total_misaligneds + len(misaligned_texts)
 
             if save_it_to_file:
@@ -807,40 +1268,97 @@ class SpacyUtils:
         return total_misaligneds
 
 
-    def evaluate_multiple(self, optimizer, nlp, texts: list, entity_occurences: list, data_type: str, save_misaligneds_to_file: bool, log_annotations: bool):
-        f_score_sum = 0
-        precision_score_sum = 0
-        recall_score_sum = 0
-        qty_misaligned_docs = 0
-        ents_per_type_sum = {}
+    def alignment_diagnostics(self, nlp, texts: list, entity_occurences: list):
+        """
+        Computes the gold alignment diagnostics of an evaluation corpus. They
+        do not change during training, so they are computed once by corpus:
+        the misaligned docs (with their BILUO alignment values and misaligned
+        texts) and the number of entities by label, in total and in misaligned
+        docs.
+
+        :param texts: A list of raw texts or pre-tokenized Docs.
+        :param entity_occurences: A list of annotations dicts.
+        """
         misaligned_docs = []
         total_by_entities = {}
         misaligned_lost_by_entities = {}
-        only_misaligneds = 0
-        total_lost_misaligned = 1
-
-        for idx in range(len(texts)):
-            text = texts[idx]
-            entities_for_text = entity_occurences[idx]
-            with nlp.use_params(optimizer.averages):
-                scores, is_misaligned_doc, alignment_values = self.evaluate(nlp, text, entities_for_text)
-                recall_score_sum += scores.get("ents_r")
-                precision_score_sum += scores.get("ents_p")
-                f_score_sum += scores.get("ents_f")
+        for text, entities_for_text in zip(texts, entity_occurences):
+            doc = make_doc(nlp, text)
+            alignment_values = spacy.gold.biluo_tags_from_offsets(doc, entities_for_text["entities"])
+            self.calculate_by_entity(total_by_entities, entities_for_text["entities"])
+            if "-" in alignment_values:
+                misaligned_docs.append(
+                    {
+                        "text": text,
+                        "entities": entities_for_text,
+                        "alignment_values": alignment_values,
+                        "misaligned_texts": self.get_misaligned_texts(alignment_values, doc),
+                    }
+                )
+                self.calculate_by_entity(misaligned_lost_by_entities, entities_for_text["entities"])
+        return {
+            "misaligned_docs": misaligned_docs,
+            "total_by_entities": total_by_entities,
+            "misaligned_lost_by_entities": misaligned_lost_by_entities,
+        }
 
-                self.calculate_by_entity(total_by_entities, entities_for_text['entities'])
+    def evaluate_data_types(
+        self, optimizer, nlp, eval_data, data_types, save_misaligneds_to_file, log_annotations, batch_size=64, n_process=1
+    ):
+        """
+        Given a dict of `data_type: (texts, entity_occurences, diagnostics)`,
+        returns a dict with the evaluate_multiple scores of each of the given
+        data types. Data types that fail to be evaluated are left out.
+        """
+        scores = {}
+        for data_type in data_types:
+            logger.info(f"Evaluating docs from {data_type} data")
+            texts, entity_occurences, diagnostics = eval_data[data_type]
+            try:
+                scores[data_type] = self.evaluate_multiple(
+                    optimizer,
+                    nlp,
+                    texts,
+                    entity_occurences,
+                    data_type,
+                    save_misaligneds_to_file,
+                    log_annotations,
+                    batch_size=batch_size,
+                    n_process=n_process,
+                    diagnostics=diagnostics,
+                )
+            except Exception:
+                logger.exception(f"The {data_type} data could not be evaluated.")
+        return scores
 
-                if is_misaligned_doc:
-                    misaligned_docs.append({"text": text, "entities":entities_for_text, "alignment_values": alignment_values})
-                    self.calculate_by_entity(misaligned_lost_by_entities, entities_for_text['entities'])
+    def evaluate_multiple(self, optimizer, nlp, texts: list, entity_occurences: list, data_type: str, save_misaligneds_to_file: bool, log_annotations: bool, batch_size=64, n_process=1, diagnostics=None):
+        """
+        Scores the model over the given texts. Averaged parameters are swapped
+        in once for the whole pass and predictions run in batches of
+        `batch_size` texts, in `n_process` processes. Entities of the whole
+        pass are scored together (see scorer.EntityScorer). Returns the micro
+        averaged F-score, precision and recall, the F-score by entity type and
+        the macro averaged F-score. Alignment `diagnostics` (see
+        alignment_diagnostics) are computed if they are not given.
+        """
+        scorer = EntityScorer()
+        if diagnostics is None:
+            diagnostics = self.alignment_diagnostics(nlp, texts, entity_occurences)
+        misaligned_docs = diagnostics["misaligned_docs"]
+        total_by_entities = diagnostics["total_by_entities"]
+        misaligned_lost_by_entities = diagnostics["misaligned_lost_by_entities"]
+        only_misaligneds = 0
+        total_lost_misaligned = 1
 
-                for key, value in scores["ents_per_type"].items():
-                    if key not in ents_per_type_sum:
-                        ents_per_type_sum[key] = value["f"]
-                    else:
-                        ents_per_type_sum[key] += value["f"]
+        # snapshots evaluated by the async worker are already averaged. Worker
+        # processes are forked within the block, so they predict with averages too
+        with nlp.use_params(optimizer.averages) if optimizer is not None else nullcontext():
+            predictions = predict_batch(nlp, texts, batch_size, n_process)
+            for text, entities_for_text, pred_value in zip(texts, entity_occurences, predictions):
+                scorer.add_doc(pred_value, aligned_entities(pred_value, entities_for_text["entities"]))
 
-        if len(misaligned_docs):
+        # misaligned annotations are only counted (and saved) when they are logged
+        if len(misaligned_docs) and log_annotations:
             only_misaligneds = self.get_total_misaligneds(nlp, save_misaligneds_to_file, f"{data_type}_misaligned_docs.json", log_annotations, misaligned_docs)
             total_lost_misaligned = functools.reduce(lambda a,b: a+b, misaligned_lost_by_entities.values())
 
@@ -851,16 +1369,118 @@ class SpacyUtils:
             logger.info(f'Lost entities because of misaligned: {total_lost_misaligned}.')
             logger.info(f'Misaligned: {only_misaligneds} ({round(only_misaligneds/total_lost_misaligned*100, 2)}%).')
 
-        for key, value in ents_per_type_sum.items():
-            ents_per_type_sum[key] = value / len(texts)
-
+        scores = scorer.scores()
+        logger.info(f"Confusion table for {data_type} data (gold -> predicted): {scores['confusion']}")
         return (
-            f_score_sum / len(texts),
-            precision_score_sum / len(texts),
-            recall_score_sum / len(texts),
-            ents_per_type_sum
+            scores["micro"]["f"],
+            scores["micro"]["p"],
+            scores["micro"]["r"],
+            {label: value["f"] for label, value in scores["per_type"].items()},
+            scores["macro"]["f"],
         )
 
+    def evaluate_model(
+        self, model_path: str, data_path: str, workers: int = 1, output_path: str = "", batch_size: int = 64
+    ):
+        """
+        Given a model (path or package name) and a converted corpus, streams
+        the corpus through the full pipeline (ner, entity_ruler,
+        entity_matcher, entity_custom) in `workers` processes. Writes as JSON
+        to the output path (or prints when it is empty) the micro and macro
+        averaged scores, the scores by label, the confusion table and the
+        throughput (docs and tokens by second, without the model loading).
+
+        :param model_path: A model path or an installed model package name.
+        :param data_path: A converted .json, .spacy or sharded corpus.
+        :param workers: An integer with the number of processes. 1 by default
+        :param output_path: A .json file where to write the results. Optional
+        :param batch_size: An integer with the number of texts by batch
+        """
+        # .spacy corpora only need the vocab to be read, texts are sent to the pipeline
+        examples = ((get_text(text), annotations) for text, annotations in iter_corpus(data_path, spacy.blank("es")))
+        batches = iter(lambda: list(islice(examples, batch_size)), [])
+        scorer = EntityScorer()
+        docs, tokens = 0, 0
+
+        def score(predicted_batches):
+            nonlocal docs, tokens
+            for batch, predictions in predicted_batches:
+                for entities, gold, n_tokens in predictions:
+                    scorer.add(entities, gold)
+                    docs += 1
+                    tokens += n_tokens
+
+        logger.info(f'Evaluating model "{model_path}" with "{data_path}" in {workers} processes')
+        if workers > 1:
+            ready = multiprocessing.Barrier(workers + 1)
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=init_inference, initargs=(model_path, ready))
+            with pool as executor:
+                # a task by worker starts all of them, and the timer starts once
+                # every worker has loaded the pipeline and reached the barrier
+                for i in range(workers):
+                    executor.submit(inference_ready, i)
+                ready.wait()
+                start = time.time()
+                score(utils.bounded_map(executor, predict_entities, batches, workers * 2))
+                seconds = time.time() - start
+        else:
+            init_inference(model_path)
+            start = time.time()
+            score((batch, predict_entities(batch)) for batch in batches)
+            seconds = time.time() - start
+
+        scores = scorer.scores()
+        results = {
+            "model": model_path,
+            "data": data_path,
+            "docs": docs,
+            "tokens": tokens,
+            "seconds": seconds,
+            "docs_per_second": docs / seconds if seconds else 0,
+            "tokens_per_second": tokens / seconds if seconds else 0,
+            **scores,
+        }
+        logger.info(f"Evaluated {docs} docs in {seconds:.2f} secs ({results['docs_per_second']:.2f} docs/s).")
+        if output_path:
+            srsly.write_json(output_path, results)
+            logger.info(f'💾 Evaluation results saved at "{output_path}".')
+        else:
+            print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    def profile_pipeline(self, model_path: str, data_path: str, output_path: str = "", max_docs: int = 0):
+        """
+        Given a model (path or package name) and a converted corpus, runs the
+        corpus texts through the full pipeline and reports the wall time of
+        the tokenizer, each component, each EntityMatcher after callback and
+        each EntityCustom rule function: totals, means and percentiles by
+        document and totals by document length bucket. Prints it as a table
+        (in milliseconds) and writes it as JSON (in seconds) to the output
+        path, or prints it when it is empty.
+
+        :param model_path: A model path or an installed model package name.
+        :param data_path: A converted .json, .spacy or sharded corpus.
+        :param output_path: A .json file where to write the report. Optional
+        :param max_docs: An integer with the maximum number of docs. 0 (all) by default
+        """
+        register_pipeline_factories()
+        nlp = spacy.load(model_path)
+        profiler = PipelineProfiler(nlp)
+        logger.info(f'Profiling pipeline {nlp.pipe_names} of "{model_path}" with "{data_path}"')
+
+        examples = iter_corpus(data_path, nlp)
+        if max_docs > 0:
+            examples = islice(examples, max_docs)
+        for text, _ in examples:
+            profiler(get_text(text))
+
+        report = profiler.report()
+        print(format_report(report))
+        if output_path:
+            srsly.write_json(output_path, report)
+            logger.info(f'💾 Pipeline profile saved at "{output_path}".')
+        else:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+
     def build_model_package(
         self, model_path: str, package_path: str, model_name: str, model_version: str, model_components: str
     ):
@@ -943,7 +1563,7 @@ Language.factories['entity_custom'] = lambda nlp, **cfg: moduloCustom.EntityCust
             f.writelines(content)
         logger.info("Succesfully write language factories to model")
 
-    def show_text(self, files_path: str, entity: str, context_words: int = 0):
+    def show_text(self, files_path: str, entity: str, context_words: int = 0, index_path: str = ""):
         """
         Given the path to a dataturks .json format input file directory and an
         entity name, prints the annotation text from label.
@@ -951,46 +1571,59 @@ Language.factories['entity_custom'] = lambda nlp, **cfg: moduloCustom.EntityCust
         :param files_path: Directory pointing to dataturks .json files
         :param entity: entity label name.
         :param context_words: integer for nbor words.
+        :param index_path: path to a SQLite concordance index. When given, the
+        index is created or updated with new and modified files and queried
+        instead of scanning every file.
         """
 
         W = "\033[0m"  # white (normal)
         R = "\033[31m"  # red
         G = "\033[32m"  # green
+
+        if index_path:
+            connection = open_index(index_path)
+            updated, removed = update_index(connection, files_path)
+            logger.info(f'Concordance index "{index_path}": {updated} files indexed, {removed} files removed.')
+            for text, left, right, start, end in find_concordances(connection, files_path, entity, context_words):
+                posicion = " -- Start: {}{} {}End: {}{}{}".format(G, str(start), W, G, str(end), W)
+                print(left + R + text + W + right + posicion if context_words else text + posicion)
+            connection.close()
+            return
+
         files = [os.path.join(files_path, f) for f in listdir(files_path) if isfile(join(files_path, f))]
         texts = []
+        seen = set()
 
         for file_ in files:
-            with open(file_, "r") as f:
-                lines = f.readlines()
-                for line in lines:
-                    data = json.loads(line)
-                    for a in data["annotation"] or []:
-                        output = ""
-                        if a["label"][0] == entity:
-                            if not a["points"][0]["text"] in texts:
-                                text = a["points"][0]["text"]
-                                if context_words:
-                                    text = re.escape(a["points"][0]["text"])
-                                    interval = r"{{0,{0}}}".format(context_words)
-                                    regex = (
-                                        r"((?:\S+\s+)"
-                                        + interval
-                                        + r"\b"
-                                        + text
-                                        + r"\b\s*(?:\S+\b\s*)"
-                                        + interval
-                                        + ")"
-                                    )
-                                    x = re.search(regex, data["content"])
-                                    if x:
-                                        output = x.group()
-                                        output = output.replace(text.replace("\\", ""), R + text + W)
-                                else:
-                                    output = text
-                                posicion = " -- Start: {}{} {}End: {}{}{}".format(
-                                    G, str(a["points"][0]["start"]), W, G, str(a["points"][0]["end"]), W
+            for data in read_dataturks_file(file_):
+                for a in data["annotation"] or []:
+                    output = ""
+                    if annotation_label(a) == entity:
+                        if not a["points"][0]["text"] in seen:
+                            seen.add(a["points"][0]["text"])
+                            text = a["points"][0]["text"]
+                            if context_words:
+                                text = re.escape(a["points"][0]["text"])
+                                interval = r"{{0,{0}}}".format(context_words)
+                                regex = (
+                                    r"((?:\S+\s+)"
+                                    + interval
+                                    + r"\b"
+                                    + text
+                                    + r"\b\s*(?:\S+\b\s*)"
+                                    + interval
+                                    + ")"
                                 )
-                                texts.append(output.replace("\\", "") + posicion)
+                                x = re.search(regex, data["content"])
+                                if x:
+                                    output = x.group()
+                                    output = output.replace(text.replace("\\", ""), R + text + W)
+                            else:
+                                output = text
+                            posicion = " -- Start: {}{} {}End: {}{}{}".format(
+                                G, str(a["points"][0]["start"]), W, G, str(a["points"][0]["end"]), W
+                            )
+                            texts.append(output.replace("\\", "") + posicion)
 
         for text in texts:
             print(text)
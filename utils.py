@@ -1,10 +1,23 @@
+import os
 import shutil
 import logging
 import datetime
+import pickle
+import queue
+import random
 import subprocess
+import threading
+from collections import deque
+from itertools import islice
+import numpy
 
 logger = logging.getLogger("Spacy cli utils.py")
 
+# Optimizer attributes saved in training checkpoints
+OPTIMIZER_STATE = ["mom1", "mom2", "averages", "nr_update"]
+# State values that only live during a run (threads, in-memory weights)
+RUNTIME_STATE = ["checkpoint_write", "ner_snapshot"]
+
 
 def set_optimizer(optimizer, learn_rate=0.001, beta1=0.9, beta2=0.999, eps=1e-8, L2=1e-3, max_grad_norm=1.0):
     """
@@ -42,7 +55,57 @@ def set_batch_size(train_config, FUNC_MAP):
             return train_config["batch_size"], ()
         else:
             b = train_config["batch_size"]
-            return (FUNC_MAP[b.pop("f")], (b["from"], b["to"], b["rate"]))
+            f = b.pop("f")
+            if f == "token_budget":
+                return (FUNC_MAP[f], (b["max_tokens"], b.get("buffer", 256)))
+            return (FUNC_MAP[f], (b["from"], b["to"], b["rate"]))
+
+
+def token_budget(max_tokens=2000, buffer=256):
+    """
+    Batch size variant that caps batches by tokens instead of by number of
+    documents. Returns a batcher: a function that given the training examples
+    (`(doc, gold)` tuples) yields batches built by `minibatch_by_tokens`.
+
+    :param max_tokens: maximum number of (padded) tokens by batch
+    :param buffer: number of examples sorted together by length
+    """
+
+    def batcher(examples, rng=random):
+        return minibatch_by_tokens(examples, max_tokens, buffer, rng)
+
+    return batcher
+
+
+def minibatch_by_tokens(examples, max_tokens, buffer=256, rng=random):
+    """
+    Reads examples in buffers of `buffer` items, sorts each buffer by length
+    and splits it in batches whose padded size (longest doc tokens x number of
+    docs) does not exceed `max_tokens`. A doc longer than `max_tokens` goes
+    alone in its batch. Batches of each buffer are shuffled so lengths are
+    not seen in increasing order.
+
+    :param examples: An iterable of `(doc, gold)` tuples
+    :param max_tokens: maximum number of (padded) tokens by batch
+    :param buffer: number of examples sorted together by length
+    :param rng: random.Random instance (or the random module) used to shuffle
+    """
+    examples = iter(examples)
+    while True:
+        chunk = sorted(islice(examples, buffer), key=lambda example: len(example[0]))
+        if not chunk:
+            return
+        batches = []
+        batch = []
+        for example in chunk:
+            # chunk is sorted, so the current doc is the longest of the batch
+            if batch and (len(batch) + 1) * len(example[0]) > max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(example)
+        batches.append(batch)
+        rng.shuffle(batches)
+        yield from batches
 
 
 def save_state_history(
@@ -59,27 +122,176 @@ def save_state_history(
     learn_rate,
     num_batches,
     dropout,
+    num_samples=None,
+    macro_f_score=None,
+    val_macro_f_score=None,
 ):
     state["history"]["ner"].append(numero_losses)
     state["history"]["f_score"].append(f_score)
+    state["history"]["macro_f_score"].append(macro_f_score)
     state["history"]["recall"].append(recall_score)
     state["history"]["precision"].append(precision_score)
     state["history"]["per_type_score"].append(per_type_score)
 
     # validation
     state["history"]["val_f_score"].append(val_f_score)
+    state["history"]["val_macro_f_score"].append(val_macro_f_score)
     state["history"]["val_recall"].append(val_recall_score)
     state["history"]["val_precision"].append(val_precision_score)
     state["history"]["val_per_type_score"].append(val_per_type_score)
 
     state["history"]["lr"].append(learn_rate)
     state["history"]["batches"].append(num_batches)
+    state["history"]["samples"].append(num_samples)
     state["history"]["dropout"].append(dropout)
 
     # this works if  iteration callacks are called later
     state["history"]["saved"].append("")
 
 
+def save_checkpoint(path, nlp, optimizer, state, order, initial_random_state):
+    """
+    Saves a checkpoint to resume an interrupted training: NER weights,
+    optimizer moments and averages, the train loop state, the training
+    examples order and the random states. It is written atomically, so an
+    interrupted write keeps the previous checkpoint.
+
+    :param path: file where to write the checkpoint
+    :param nlp: the model being trained
+    :param optimizer: the model optimizer
+    :param state: the train loop state
+    :param order: indexes of the training examples in their current order
+    :param initial_random_state: random state from before loading the data
+    """
+    checkpoint = {
+        "ner": nlp.get_pipe("ner").to_bytes(exclude=["vocab"]),
+        "optimizer": {key: getattr(optimizer, key) for key in OPTIMIZER_STATE},
+        "state": {key: value for key, value in state.items() if key not in RUNTIME_STATE},
+        "order": order,
+        "random_state": random.getstate(),
+        "numpy_random_state": numpy.random.get_state(),
+        "initial_random_state": initial_random_state,
+    }
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+    logger.info(f"💾 Saved checkpoint of epoch {state['i']} in {path}")
+
+
+def load_checkpoint(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def restore_checkpoint(checkpoint, nlp, optimizer, state):
+    """
+    Restores the NER weights, optimizer, train loop state and random states
+    saved by `save_checkpoint`.
+    """
+    nlp.get_pipe("ner").from_bytes(checkpoint["ner"], exclude=["vocab"])
+    for key, value in checkpoint["optimizer"].items():
+        setattr(optimizer, key, value)
+    state.update(checkpoint["state"])
+    random.setstate(checkpoint["random_state"])
+    numpy.random.set_state(checkpoint["numpy_random_state"])
+
+
+def bounded_map(executor, fn, iterable, max_pending):
+    """
+    Like executor.map but keeps at most `max_pending` tasks in flight, so an
+    iterable larger than memory can be streamed through a process pool.
+    Yields `(item, result)` tuples in the iterable order.
+
+    :param executor: A concurrent.futures executor
+    :param fn: The function applied to each item
+    :param iterable: The items to process
+    :param max_pending: The maximum number of submitted and unfinished tasks
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= max_pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def prefetch(iterable, size=2):
+    """
+    Iterates `iterable` in a background thread keeping up to `size` items
+    ready in a bounded queue, so building the next items overlaps with the
+    work done on the current one. Exceptions raised while producing are
+    raised again in the consumer. If the consumer stops early the thread
+    stops too.
+
+    :param iterable: The items to produce
+    :param size: The maximum number of items produced ahead
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def backup_path(path, suffix="_copy_with_misaligned"):
+    """
+    Returns a backup path for a .json file or a directory that does not
+    exist yet: the path with `suffix` before the .json extension, plus a
+    number when older backups exist.
+    """
+    base, extension = (path[: -len(".json")], ".json") if path.endswith(".json") else (path, "")
+    backup = f"{base}{suffix}{extension}"
+    copies = 1
+    while os.path.exists(backup):
+        backup = f"{base}{suffix}_{copies}{extension}"
+        copies += 1
+    return backup
+
+
+def remove_path(path):
+    """
+    Removes a file or a directory tree, if it exists.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
 def run_command_with_timer(*args):
     """
     Calculate the time spend to run command